@@ -8,9 +8,15 @@
 import xml.dom.minidom
 import copy
 import guid
+import hashindex
+import instrument
+import kernels
 import math
 import os
 import numpy
+import multiprocessing
+import sys
+import time
 
 # A couple contants
 CONTINUOUS = 0
@@ -19,7 +25,7 @@ DISCRETE = 1
 class HMM:
     ''' Code for a hidden Markov Model '''
 
-    def __init__(self, states, features, contOrDisc, numVals):
+    def __init__(self, states, features, contOrDisc, numVals, order=1):
         ''' Initialize the HMM.
             Input:
                 states: a list of the hidden state possible values
@@ -27,7 +33,9 @@ class HMM:
                 contOrDisc: a dictionary mapping feature names to integers
                     representing whether the feature is continuous or discrete
                 numVals: a dictionary mapping names of discrete features to
-                    the number of values that feature can take on. '''
+                    the number of values that feature can take on.
+                order: 1 for the usual transitions P(s_t | s_t-1), 2 to
+                    also learn P(s_t | s_t-2, s_t-1) and decode with it '''
         self.states = states 
         self.isTrained = False
         self.featureNames = features
@@ -41,6 +49,18 @@ class HMM:
         self.priors = None
         self.emissions = None   #evidence model
         self.transitions = None #transition model
+        self.order = order
+        # second order transition model, transitions2[s2][s1][s] is
+        # P(s at t | s2 at t-2, s1 at t-1)
+        self.transitions2 = None
+
+        # Global thresholds for binning the stroke features, if they were
+        # learned in training (see StrokeLabeler.trainHMM)
+        self.binEdges = None
+
+        # The dtype of the arrays of logModel(), float32 for compact
+        # labelers
+        self.dtype = float
 
     def train(self, trainingData, trainingLabels):
         ''' Train the HMM on the fully observed data using MLE '''
@@ -48,10 +68,14 @@ class HMM:
         self.isTrained = True
         self.trainPriors( trainingData, trainingLabels )
         self.trainTransitions( trainingData, trainingLabels )
+        if self.order == 2:
+            self.trainTransitions2( trainingData, trainingLabels )
         self.trainEmissions( trainingData, trainingLabels ) 
         print "HMM trained"
         print "Prior probabilities are:", self.priors
         print "Transition model is:", self.transitions
+        if self.order == 2:
+            print "Second order transition model is:", self.transitions2
         print "Evidence model is:", self.emissions
 
     def trainPriors( self, trainingData, trainingLabels ):
@@ -92,6 +116,26 @@ class HMM:
             for s2 in transitionCounts[s].keys():
                 self.transitions[s][s2] = float(transitionCounts[s][s2])/float(totForS)
 
+    def trainTransitions2( self, trainingData, trainingLabels ):
+        ''' Train the second order transition model P(s_t | s_t-2, s_t-1)
+            from every run of three labels.  Counts use add 1 smoothing,
+            since many label triples are rare or never seen. '''
+        counts = {}
+        for s2 in self.states:
+            counts[s2] = {}
+            for s1 in self.states:
+                counts[s2][s1] = dict([(s, 1) for s in self.states])
+        for labels in trainingLabels:
+            for t in range(2, len(labels)):
+                counts[labels[t-2]][labels[t-1]][labels[t]] += 1
+
+        self.transitions2 = {}
+        for s2 in self.states:
+            self.transitions2[s2] = {}
+            for s1 in self.states:
+                tot = float(sum(counts[s2][s1].values()))
+                self.transitions2[s2][s1] = dict([(s, counts[s2][s1][s] / tot)
+                                                  for s in self.states])
 
     def trainEmissions( self, trainingData, trainingLabels ):
         ''' given training data and labels, train the evidence model.  '''
@@ -139,99 +183,161 @@ class HMM:
     def label( self, data ):
 
         ''' Find the most likely labels for the sequence of data
-            This is an implementation of the Viterbi algorithm '''
-
-        #Debugging tools to help see what is being accessed
-        # print "Data is: " + str(data)
-        # print "States are: " + str(self.states)
-        # print "FeatureNames are: " + str(self.featureNames)
-        # print "Emissions are: " + str(self.emissions)
-        # print "Feature Indices are " + str(self.featureIndices)
-        # print "Transitions are " + str(self.transitions)
-        # print "States are " + str(self.states)
-        # print "------------------------------------------------------"
-
-        #creates a list of dictionaries that will hold the partial probabilities of each state
-        #viterbi_calc will be used to refer to the prior partial probabilities in the code below
-        viterbi_calc = [{}]
-        path = {}
-
-        #calculating partial probability of first day/state
-        for state in self.states:
-
-            #keeps tracks of the evidence probability of every feature
-            first_feature_vals = []
-
+            This is an implementation of the Viterbi algorithm.  Path
+            probabilities are added up as logs (see LogModel.viterbi), since
+            multiplying them underflows to 0 on long sketches; kernels.py
+            only picks how the loop runs, never the result. '''
+        if self.order == 2:
+            return self.labelSecondOrder( data )
+        model = self.logModel()
+        score, path = model.viterbi(model.logEvidence(model.encode(data)))
+        labels = [self.states[s] for s in path]
+
+        print "Best path is: " + str(labels)
+        print "Prob of best path is: " + str(math.exp(score))
+
+        return labels
+
+    def labelSecondOrder( self, data ):
+        ''' Viterbi with the second order transition model (see
+            LogModel.viterbi2).  The first transition of a sketch has no
+            label two strokes back, so it uses the first order model. '''
+        model = self.logModel()
+        evidence = model.logEvidence(model.encode(data))
+        score, path = model.viterbi2(evidence)
+        return [self.states[s] for s in path]
+
+    def labelSegments( self, data, starts, workers=None ):
+        ''' Find the most likely labels like label, decoding the segments
+            of data that begin at the given positions separately (in
+            parallel with workers > 1) and joining them exactly (see
+            LogModel.viterbiSegments).  First order models only; a second
+            order model labels the whole sequence at once. '''
+        if self.order == 2:
+            return self.labelSecondOrder( data )
+        model = self.logModel()
+        evidence = model.logEvidence(model.encode(data))
+        score, path = model.viterbiSegments(evidence, starts, workers)
+        return [self.states[s] for s in path]
+
+    def labelScan( self, data, workers=None ):
+        ''' Find the most likely labels like label, with the max-plus scan
+            decoder (see LogModel.viterbiScan) in workers processes.  First
+            order models only; a second order model uses labelSecondOrder. '''
+        if self.order == 2:
+            return self.labelSecondOrder( data )
+        model = self.logModel()
+        evidence = model.logEvidence(model.encode(data))
+        score, path = model.viterbiScan(evidence, workers)
+        return [self.states[s] for s in path]
+
+    def labelKBest( self, data, k ):
+        ''' Find the k most likely label sequences for the sequence of data.
+            Returns a list of (log probability, labels) tuples, best first.
+            Fewer than k tuples come back if there are fewer possible paths.
+            A second order model ranks paths with its second order
+            transitions (see LogModel.kBest2), like label. '''
+        model = self.logModel()
+        evidence = model.logEvidence(model.encode(data))
+        if self.order == 2:
+            paths = model.kBest2(evidence, k)
+        else:
+            paths = model.kBest(evidence, k)
+        return [(score, [self.states[s] for s in path]) for (score, path) in paths]
+
+    def logModel( self ):
+        ''' Return the trained model as a LogModel (arrays of log probabilities) '''
+        return LogModel(self)
+
+    def maximize( self, counts ):
+        ''' The M step of Baum-Welch: set the priors, transitions and emissions
+            from expected counts (see LogModel.expectedCounts).  Discrete
+            emissions use the same add 1 smoothing as trainEmissions.  A
+            state that is never followed by another one gets uniform
+            transitions, where train would divide by zero. '''
+        priors = counts['priors']
+        transitions = counts['transitions']
+        self.priors = {}
+        self.transitions = {}
+        self.emissions = {}
+        for i, s in enumerate(self.states):
+            self.priors[s] = priors[i] / priors.sum()
+            self.transitions[s] = {}
+            total = transitions[i].sum()
+            for j, s2 in enumerate(self.states):
+                if total > 0:
+                    self.transitions[s][s2] = transitions[i, j] / total
+                else:
+                    self.transitions[s][s2] = 1.0 / len(self.states)
+            self.emissions[s] = {}
             for f in self.featureNames:
-                #gets the value of the feature f at first day
-                first_value = data[0][f]
-
-                #gets the index of the feature f (e.g. Dry's index is 0, Dryish's index is 1, etc.)
-                index = self.featureIndices[f][first_value]
-
-                #add to the feature_vals
-                first_feature_vals.append(self.emissions[state][f][index])
-
-            #can multiply the probabilities together because we assume they are independent
-            first_evi = 1
-            for feat in first_feature_vals:
-                first_evi *= feat
-
-            #calculates the partial probability at the first step
-            viterbi_calc[0][state] = self.priors[state] * first_evi
-
-            #puts the current state as the first step in the path of the current state
-            path[state] = [state]
-
-
-        #Run Viterbi for t > 0
-        #counter = 0
-        for t in range(1, len(data)):
-            #add new dictionaries
-            viterbi_calc.append({})
-            new_path = {}
-
-
-            for y in self.states:
-                curr_feature_vals = []
-
-                for f0 in self.featureNames:
-                    #gets the value of the feature f at day t
-                    curr_val = data[t][f0]
-
-                    #gets the index of the feature f (e.g. Dry's index is 0, Dryish's index is 1, etc.)
-                    idx = self.featureIndices[f0][curr_val]
-
-                    curr_feature_vals.append(self.emissions[y][f0][idx])
-                curr_evi = 1
-                for curr_feat in curr_feature_vals:
-                    curr_evi *= curr_feat
-
-                #gets the max partial probability of the current state
-                (prob, state) = max((viterbi_calc[t-1][y0]*self.transitions[y0][y]*curr_evi, y0) for y0 in self.states)
-
-                #assigns prob (the partial probability of the current state) to the viterbi calculation dictionary and keeps track of the paths taken so far
-                viterbi_calc[t][y] = prob
-
-                #keep track of the paths so far
-                new_path[y] = path[state] + [y]
-
-            #don't have to remember old path
-            path = new_path
-
-            
-        #gets the max viterbi calculation with its accompanying best path
-        (prob, state) = max((viterbi_calc[t][s1], s1) for s1 in self.states)
+                fcounts = counts['emissions'][f][i]
+                if self.featuresCorD[f] == CONTINUOUS:
+                    # fcounts is (weight, weighted sum, weighted sum of squares)
+                    mean = fcounts[1] / fcounts[0]
+                    sigma = math.sqrt(max(fcounts[2] / fcounts[0] - mean**2, 0.0))
+                    self.emissions[s][f] = [mean, sigma]
+                if self.featuresCorD[f] == DISCRETE:
+                    self.emissions[s][f] = list((fcounts + 1) / (fcounts.sum() + self.numVals[f]))
+        if counts.get('transitions2') is not None:
+            # add 1 smoothing, as in trainTransitions2
+            triples = counts['transitions2'] + 1
+            triples = triples / triples.sum(axis=2)[:, :, None]
+            self.transitions2 = {}
+            for i, s2 in enumerate(self.states):
+                self.transitions2[s2] = {}
+                for j, s1 in enumerate(self.states):
+                    self.transitions2[s2][s1] = dict([(s, triples[i, j, k])
+                                                      for k, s in enumerate(self.states)])
+        self.isTrained = True
 
-        print "Best path is: " + str(path[state])
-        print "Prob of best path is: " + str(prob)
+    def emptyCounts( self ):
+        ''' Zero label counts in the layout of LogModel.expectedCounts, to
+            be filled in one sketch at a time by countSketch '''
+        S = len(self.states)
+        counts = {'priors': numpy.zeros(S),
+                  'transitions': numpy.zeros((S, S)),
+                  'transitions2': None,
+                  'emissions': {},
+                  'logLikelihood': 0.0,
+                  'sequences': 0}
+        if self.order == 2:
+            counts['transitions2'] = numpy.zeros((S, S, S))
+        for f in self.featureNames:
+            if self.featuresCorD[f] == DISCRETE:
+                counts['emissions'][f] = numpy.zeros((S, self.numVals[f]))
+            else:
+                counts['emissions'][f] = numpy.zeros((S, 3))
+        return counts
+
+    def countSketch( self, counts, data, labels ):
+        ''' Add one fully labeled sketch (its feature dictionaries and
+            labels) into counts.  Counting every training sketch and then
+            calling maximize gives the same model as train. '''
+        if len(labels) == 0:
+            return counts
+        stateIndex = dict([(s, i) for i, s in enumerate(self.states)])
+        codes = numpy.array([stateIndex[l] for l in labels])
+        counts['priors'][codes[0]] += 1
+        numpy.add.at(counts['transitions'], (codes[:-1], codes[1:]), 1)
+        if counts['transitions2'] is not None:
+            numpy.add.at(counts['transitions2'], (codes[:-2], codes[1:-1], codes[2:]), 1)
+        for f in self.featureNames:
+            fcounts = counts['emissions'][f]
+            values = numpy.array([d[f] for d in data])
+            if self.featuresCorD[f] == DISCRETE:
+                numpy.add.at(fcounts, (codes, values.astype(int)), 1)
+            else:
+                numpy.add.at(fcounts[:, 0], codes, 1)
+                numpy.add.at(fcounts[:, 1], codes, values)
+                numpy.add.at(fcounts[:, 2], codes, values**2)
+        counts['sequences'] += 1
+        return counts
 
-        return path[state]
 
 
 
 
-    
     def getEmissionProb( self, state, features ):
         ''' Get P(features|state).
             Consider each feature independent so
@@ -251,10 +357,775 @@ class HMM:
                 prob *= self.emissions[state][f][fval]
                 
         return prob
-        
 
 
 
+class LogModel:
+    ''' An array view of a trained HMM.  Every probability is stored as a log,
+        indexed by state number (the position of the state in hmm.states),
+        so the decoders below can work on all the states at once.  The
+        arrays, and the evidence computed from them, have the HMM's dtype;
+        the decoders add up path scores in float64 whatever it is. '''
+
+    def __init__(self, hmm):
+        self.dtype = getattr(hmm, 'dtype', float)
+        self.states = list(hmm.states)
+        self.featureNames = list(hmm.featureNames)
+        self.featuresCorD = dict(hmm.featuresCorD)
+        self.featureIndices = dict(hmm.featureIndices)
+
+        S = len(self.states)
+        with numpy.errstate(divide='ignore'):
+            self.logPriors = numpy.log([hmm.priors[s] for s in self.states])
+            self.logTransitions = numpy.log([[hmm.transitions[s][s2] for s2 in self.states]
+                                             for s in self.states])
+
+            # discrete features get an S x numVals table of log probabilities,
+            # continuous features an S x 2 table of (mean, sigma)
+            self.tables = {}
+            for f in self.featureNames:
+                table = numpy.array([hmm.emissions[s][f] for s in self.states], dtype=float)
+                if self.featuresCorD[f] == DISCRETE:
+                    table = numpy.log(table)
+                self.tables[f] = table.reshape(S, -1)
+
+            # logTransitions2[i, j, k] is log P(k at t | i at t-2, j at t-1)
+            self.logTransitions2 = None
+            if getattr(hmm, 'transitions2', None) != None:
+                self.logTransitions2 = numpy.log([[[hmm.transitions2[s2][s1][s] for s in self.states]
+                                                   for s1 in self.states]
+                                                  for s2 in self.states])
+
+        if self.dtype != float:
+            self.logPriors = self.logPriors.astype(self.dtype)
+            self.logTransitions = self.logTransitions.astype(self.dtype)
+            for f in self.tables:
+                self.tables[f] = self.tables[f].astype(self.dtype)
+            if self.logTransitions2 is not None:
+                self.logTransitions2 = self.logTransitions2.astype(self.dtype)
+
+    def encode( self, data ):
+        ''' Turn a list of feature dictionaries into a T x F array of feature
+            values, with discrete values replaced by their emission index '''
+        codes = numpy.zeros((len(data), len(self.featureNames)), dtype=self.dtype)
+        for j, f in enumerate(self.featureNames):
+            indices = self.featureIndices.get(f)
+            if self.featuresCorD[f] == DISCRETE and indices is not None:
+                codes[:, j] = [indices[d[f]] for d in data]
+            else:
+                codes[:, j] = [d[f] for d in data]
+        return codes
+
+    def logEvidence( self, codes ):
+        ''' Return the T x S array of log P(features at t | state) '''
+        ret = numpy.zeros((len(codes), len(self.states)), dtype=self.dtype)
+        for j, f in enumerate(self.featureNames):
+            table = self.tables[f]
+            if self.featuresCorD[f] == DISCRETE:
+                ret += table[:, codes[:, j].astype(int)].T
+            else:
+                mean = table[:, 0]
+                sigma = table[:, 1]
+                diff = codes[:, j][:, None] - mean
+                ret += -diff**2 / (2*sigma**2) - numpy.log(sigma * math.sqrt(2*math.pi))
+        return ret
+
+    def expectedCounts( self, codesList ):
+        ''' The E step of Baum-Welch.  Run forward-backward (scaled) on each
+            encoded sequence and return the summed expected counts as a
+            dictionary with keys 'priors' (S), 'transitions' (S x S),
+            'emissions' (feature name -> S x numVals for discrete features,
+            S x 3 weight/sum/sum of squares for continuous ones),
+            'logLikelihood' and 'sequences'. '''
+        S = len(self.states)
+        counts = {'priors': numpy.zeros(S),
+                  'transitions': numpy.zeros((S, S)),
+                  'emissions': {},
+                  'logLikelihood': 0.0,
+                  'sequences': 0}
+        for f in self.featureNames:
+            if self.featuresCorD[f] == DISCRETE:
+                counts['emissions'][f] = numpy.zeros(self.tables[f].shape)
+            else:
+                counts['emissions'][f] = numpy.zeros((S, 3))
+
+        A = numpy.exp(self.logTransitions)
+        pi = numpy.exp(self.logPriors)
+        for codes in codesList:
+            T = len(codes)
+            if T == 0:
+                continue
+            evidence = self.logEvidence(codes)
+            shift = evidence.max(axis=1)
+            B = numpy.exp(evidence - shift[:, None])
+
+            alpha = numpy.zeros((T, S))
+            scale = numpy.zeros(T)
+            alpha[0] = pi * B[0]
+            scale[0] = alpha[0].sum()
+            alpha[0] /= scale[0]
+            for t in range(1, T):
+                alpha[t] = alpha[t-1].dot(A) * B[t]
+                scale[t] = alpha[t].sum()
+                alpha[t] /= scale[t]
+
+            beta = numpy.ones((T, S))
+            for t in range(T-2, -1, -1):
+                beta[t] = A.dot(B[t+1] * beta[t+1]) / scale[t+1]
+
+            gamma = alpha * beta
+            counts['priors'] += gamma[0]
+            if T > 1:
+                counts['transitions'] += A * alpha[:-1].T.dot(B[1:] * beta[1:] / scale[1:, None])
+            for j, f in enumerate(self.featureNames):
+                col = codes[:, j]
+                fcounts = counts['emissions'][f]
+                if self.featuresCorD[f] == DISCRETE:
+                    col = col.astype(int)
+                    for v in range(fcounts.shape[1]):
+                        fcounts[:, v] += gamma[col == v].sum(axis=0)
+                else:
+                    fcounts[:, 0] += gamma.sum(axis=0)
+                    fcounts[:, 1] += gamma.T.dot(col)
+                    fcounts[:, 2] += gamma.T.dot(col**2)
+            counts['logLikelihood'] += numpy.log(scale).sum() + shift.sum()
+            counts['sequences'] += 1
+        return counts
+
+    def viterbi( self, evidence ):
+        ''' First order Viterbi given the T x S array of log evidence, all
+            states updated at once.  Returns (log probability, path) where
+            path is a list of state numbers. '''
+        T, S = evidence.shape
+        if T == 0:
+            return (-numpy.inf, [])
+        loop = kernels.get('viterbi')
+        if loop is not None:
+            score, path = loop(self.logPriors.astype(float), self.logTransitions.astype(float),
+                               numpy.ascontiguousarray(evidence, dtype=float))
+            return (score, [int(s) for s in path])
+        delta = self.logPriors.astype(float) + evidence[0]
+        back = numpy.zeros((T, S), dtype=int)
+        for t in range(1, T):
+            # cand[i, j]: extend the best path ending in i with j
+            cand = delta[:, None] + self.logTransitions
+            back[t] = cand.argmax(axis=0)
+            delta = cand.max(axis=0) + evidence[t]
+
+        s = int(delta.argmax())
+        score = delta[s]
+        path = [s]
+        for t in range(T-1, 0, -1):
+            s = back[t, s]
+            path.append(s)
+        path.reverse()
+        return (score, [int(s) for s in path])
+
+    def transfer( self, evidence, first ):
+        ''' Viterbi over one segment of a sequence, once for every state
+            the step before the segment could be in (all at once).  Returns
+            (scores, back): scores[i, j] is the best log prob of the segment
+            ending in j after state i, back the T x S x S back pointers for
+            segmentPath.  The first segment of a sequence starts from the
+            priors instead, so its scores have a single row. '''
+        T, S = evidence.shape
+        if first:
+            scores = (self.logPriors.astype(float) + evidence[0])[None, :]
+        else:
+            scores = self.logTransitions.astype(float) + evidence[0]
+        back = numpy.zeros((T, scores.shape[0], S), dtype=int)
+        for t in range(1, T):
+            # cand[e, i, j]: entered after e, extend the best path ending in i with j
+            cand = scores[:, :, None] + self.logTransitions
+            back[t] = cand.argmax(axis=1)
+            scores = cand.max(axis=1) + evidence[t]
+        return scores, back
+
+    def segmentPath( self, back, entry, last ):
+        ''' The best path through a segment (see transfer) entered after
+            state entry and ending in state last '''
+        path = [last]
+        for t in range(len(back)-1, 0, -1):
+            last = back[t, entry, last]
+            path.append(last)
+        path.reverse()
+        return [int(s) for s in path]
+
+    def viterbiSegments( self, evidence, starts, workers=None ):
+        ''' Exact Viterbi on a sequence cut into segments at the given
+            start positions.  The segments are decoded independently (in a
+            pool of worker processes when workers > 1) with transfer, then
+            a small Viterbi over the segments picks the state each segment
+            ends in, which fixes the state each one is entered from.  Gives
+            the same result as viterbi.  Returns (log probability, path). '''
+        T, S = evidence.shape
+        if T == 0:
+            return (-numpy.inf, [])
+        bounds = sorted(set([0] + [s for s in starts if 0 < s < T])) + [T]
+        tasks = [(evidence[a:b], a == 0) for a, b in zip(bounds[:-1], bounds[1:])]
+        if workers is not None and workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(workers, len(tasks)), _initModelWorker, (self,))
+            try:
+                segments = pool.map(_segmentTransfer, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            segments = [self.transfer(e, first) for e, first in tasks]
+
+        # best[j]: best log prob of everything so far, ending in j
+        best = segments[0][0][0]
+        entries = [None]
+        for scores, back in segments[1:]:
+            cand = best[:, None] + scores
+            entries.append(cand.argmax(axis=0))
+            best = cand.max(axis=0)
+
+        last = int(best.argmax())
+        score = best[last]
+        path = []
+        for k in range(len(segments)-1, -1, -1):
+            entry = 0 if k == 0 else int(entries[k][last])
+            path = self.segmentPath(segments[k][1], entry, last) + path
+            last = entry
+        return (score, path)
+
+    def stepMatrices( self, evidence, entry ):
+        ''' The Viterbi recursion over a block of steps as max-plus
+            matrices: M[t][i, j] is the log prob of moving from i to j and
+            seeing evidence[t].  The first matrix instead holds the scores
+            of the block's first step in every row, starting from the
+            priors (entry None) or from the scores entry of the step before
+            the block.  Returns (M, back pointers of the first step). '''
+        T, S = evidence.shape
+        M = self.logTransitions.astype(float) + evidence[:, None, :]
+        if entry is None:
+            first = self.logPriors.astype(float) + evidence[0]
+            firstBack = None
+        else:
+            cand = entry[:, None] + self.logTransitions
+            first = cand.max(axis=0) + evidence[0]
+            firstBack = cand.argmax(axis=0)
+        M[0] = first
+        return M, firstBack
+
+    def reduceBlock( self, evidence, first ):
+        ''' The max-plus product of a block's step matrices: [i, j] is the
+            best log prob of the block ending in j after state i (every row
+            the same for the first block) '''
+        M = self.logTransitions.astype(float) + evidence[:, None, :]
+        if first:
+            M[0] = self.logPriors.astype(float) + evidence[0]
+        return maxPlusReduce(M)
+
+    def scanBlock( self, evidence, entry ):
+        ''' Viterbi over a block as a max-plus scan.  entry is the scores of
+            the step before the block (None at the start of the sequence).
+            Returns (scores of the block's last step, paths, entryBack):
+            paths[j] is the best path through the block ending in j and
+            entryBack[j] the state before the block on that path. '''
+        T, S = evidence.shape
+        M, firstBack = self.stepMatrices(evidence, entry)
+        delta = maxPlusScan(M)[:, 0, :]
+        # C[t] maps the state at t+1 to the best state at t
+        C = numpy.empty((T, S), dtype=int)
+        C[:-1] = (delta[:-1, :, None] + self.logTransitions).argmax(axis=1)
+        C[-1] = numpy.arange(S)
+        paths = composeScan(C).T
+        entryBack = None
+        if firstBack is not None:
+            entryBack = firstBack[paths[:, 0]]
+        return delta[-1], paths, entryBack
+
+    def viterbiScan( self, evidence, workers=None, blocks=None ):
+        ''' Viterbi as an associative max-plus scan, with no loop over the
+            steps.  The sequence is cut into blocks (one per worker by
+            default).  The blocks' matrix products are taken in parallel,
+            a short scan over them gives the scores entering each block,
+            then the blocks are scanned and backtraced in parallel and
+            joined through their entry back pointers.  Gives the same path
+            as viterbi.  Returns (log probability, path). '''
+        T, S = evidence.shape
+        if T == 0:
+            return (-numpy.inf, [])
+        if blocks is None:
+            blocks = workers or 1
+        bounds = [T * k // blocks for k in range(blocks)] + [T]
+        bounds = sorted(set(bounds))
+        pieces = [evidence[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+        pool = None
+        if workers is not None and workers > 1 and len(pieces) > 1:
+            pool = multiprocessing.Pool(min(workers, len(pieces)), _initModelWorker, (self,))
+
+        def run(name, tasks):
+            if pool is not None:
+                return pool.map(_modelMethod, [(name, args) for args in tasks])
+            return [getattr(self, name)(*args) for args in tasks]
+
+        try:
+            entries = [None]
+            if len(pieces) > 1:
+                products = run('reduceBlock', [(e, k == 0) for k, e in enumerate(pieces[:-1])])
+                entry = products[0][0]
+                entries.append(entry)
+                for A in products[1:]:
+                    entry = (entry[:, None] + A).max(axis=0)
+                    entries.append(entry)
+            results = run('scanBlock', zip(pieces, entries))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        last = int(results[-1][0].argmax())
+        score = results[-1][0][last]
+        path = []
+        for delta, paths, entryBack in reversed(results):
+            path = list(paths[last]) + path
+            if entryBack is not None:
+                last = entryBack[last]
+        return (score, [int(s) for s in path])
+
+    def decode( self, evidence ):
+        ''' The best path with the model's own transitions: second order if
+            it has them, first order otherwise '''
+        if self.logTransitions2 is not None:
+            return self.viterbi2(evidence)
+        return self.viterbi(evidence)
+
+    def viterbi2( self, evidence ):
+        ''' Second order Viterbi given the T x S array of log evidence.  The
+            hidden state is the pair (state at t-1, state at t), so delta is
+            an S x S array and each step is one S x S x S array operation.
+            Returns (log probability, path) where path is a list of state
+            numbers. '''
+        T, S = evidence.shape
+        if T == 0:
+            return (-numpy.inf, [])
+        first = self.logPriors.astype(float) + evidence[0]
+        if T == 1:
+            return (first.max(), [int(first.argmax())])
+
+        # delta[i, j] is the best log prob of a path ending in i, then j
+        delta = first[:, None] + self.logTransitions + evidence[1]
+        back = numpy.zeros((T, S, S), dtype=int)
+        for t in range(2, T):
+            # cand[i, j, k]: extend the path ending in (i, j) with k
+            cand = delta[:, :, None] + self.logTransitions2
+            back[t] = cand.argmax(axis=0)
+            delta = cand.max(axis=0) + evidence[t]
+
+        j, k = numpy.unravel_index(delta.argmax(), delta.shape)
+        score = delta[j, k]
+        path = [k, j]
+        for t in range(T-1, 1, -1):
+            j, k = back[t, j, k], j
+            path.append(j)
+        path.reverse()
+        return (score, [int(s) for s in path])
+
+    def kBest( self, evidence, k ):
+        ''' List Viterbi: find the k best state paths given the T x S array of
+            log evidence (see kBestPaths).  Returns a list of (log
+            probability, path) tuples where path is a list of state numbers. '''
+        return kBestPaths(self.logPriors, self.logTransitions, evidence, k)
+
+    def kBest2( self, evidence, k ):
+        ''' kBest with the second order transition model.  Like viterbi2,
+            the hidden state is the pair (state at t-1, state at t): pair
+            i*S + j can only be followed by pair j*S + k, with log
+            probability logTransitions2[i, j, k], and the first pair starts
+            from the priors and the first order transitions.  Returns a
+            list of (log probability, path) tuples, best first. '''
+        T, S = evidence.shape
+        if T < 2:
+            return self.kBest(evidence, k)
+        evidence = evidence.astype(float)
+        pairPriors = ((self.logPriors.astype(float) + evidence[0])[:, None] +
+                      self.logTransitions).reshape(S*S)
+        pairEvidence = numpy.tile(evidence[1:], (1, S))
+        pairTransitions = numpy.empty((S, S, S, S))
+        pairTransitions.fill(-numpy.inf)
+        for j in range(S):
+            pairTransitions[:, j, j, :] = self.logTransitions2[:, j, :]
+        ret = []
+        for score, pairs in kBestPaths(pairPriors, pairTransitions.reshape(S*S, S*S),
+                                       pairEvidence, k):
+            ret.append((score, [pairs[0] // S] + [p % S for p in pairs]))
+        return ret
+
+
+def kBestPaths( logPriors, logTransitions, evidence, k ):
+    ''' List Viterbi: find the k best state paths given log priors, an S x S
+        array of log transitions and the T x S array of log evidence.  Each
+        state keeps only its k best partial paths (a bounded top-k instead of
+        a heap, so all states are updated in one array operation).  Returns a
+        list of (log probability, path) tuples where path is a list of state
+        numbers. '''
+    T, S = evidence.shape
+    if T == 0 or k < 1:
+        return []
+
+    # scores[s, r] is the log prob of the r-th best partial path ending in s
+    scores = numpy.empty((S, k))
+    scores.fill(-numpy.inf)
+    scores[:, 0] = logPriors + evidence[0]
+
+    # back pointers: which (previous state, previous rank) each entry extends
+    backState = numpy.zeros((T, S, k), dtype=int)
+    backRank = numpy.zeros((T, S, k), dtype=int)
+    cols = numpy.arange(S)
+    for t in range(1, T):
+        # rows are (previous state, rank) pairs, columns are the new state
+        cand = (scores[:, :, None] + logTransitions[:, None, :]).reshape(S*k, S)
+        top = _topK(cand, k)
+        scores = (cand[top, cols] + evidence[t]).T
+        backState[t] = (top // k).T
+        backRank[t] = (top % k).T
+
+    final = scores.reshape(S*k)
+    ret = []
+    for idx in _topK(final[:, None], k)[:, 0]:
+        if final[idx] == -numpy.inf:
+            break
+        s, r = idx // k, idx % k
+        path = [s]
+        for t in range(T-1, 0, -1):
+            s, r = backState[t, s, r], backRank[t, s, r]
+            path.append(s)
+        path.reverse()
+        ret.append((final[idx], [int(s) for s in path]))
+    return ret
+
+
+def _topK( values, k ):
+    ''' Row indices of the k largest entries in each column of values, largest
+        first.  Only the top k are sorted, the rest is a partial selection. '''
+    n = values.shape[0]
+    k = min(k, n)
+    cols = numpy.arange(values.shape[1])
+    top = numpy.argpartition(-values, k-1, axis=0)[:k]
+    order = numpy.argsort(-values[top, cols], axis=0, kind='mergesort')
+    return top[order, cols]
+
+
+def maxPlus( A, B ):
+    ''' The max-plus products A[n] (x) B[n] of two stacks of square
+        matrices: C[n, i, j] = max over k of A[n, i, k] + B[n, k, j] '''
+    return (A[:, :, :, None] + B[:, None, :, :]).max(axis=2)
+
+def maxPlusReduce( M ):
+    ''' The max-plus product M[0] (x) M[1] (x) ... of a stack of matrices,
+        multiplying neighbouring pairs all at once (log n array steps) '''
+    while len(M) > 1:
+        odd = M[-1:] if len(M) % 2 else M[:0]
+        M = numpy.concatenate([maxPlus(M[0:len(M)-1:2], M[1::2]), odd])
+    return M[0]
+
+def maxPlusScan( M ):
+    ''' All the prefix products P[t] = M[0] (x) ... (x) M[t] of a stack of
+        matrices, by Hillis-Steele doubling (log n array steps) '''
+    P = M.copy()
+    d = 1
+    while d < len(P):
+        P[d:] = maxPlus(P[:-d], P[d:])
+        d *= 2
+    return P
+
+def composeScan( C ):
+    ''' C[t] maps a state at step t+1 to one at step t.  Returns the maps
+        from the last step back to every step, C[t] o C[t+1] o ..., by
+        pointer jumping (log n array steps) '''
+    C = C.copy()
+    d = 1
+    while d < len(C):
+        C[:-d] = numpy.take_along_axis(C[:-d], C[d:], axis=1)
+        d *= 2
+    return C
+
+
+def addCounts( counts, more ):
+    ''' Add the expected counts in more into counts (see LogModel.expectedCounts) '''
+    if counts is None:
+        return more
+    for key in ['priors', 'transitions', 'logLikelihood', 'sequences']:
+        counts[key] += more[key]
+    if counts.get('transitions2') is not None:
+        counts['transitions2'] += more['transitions2']
+    for f in counts['emissions']:
+        counts['emissions'][f] += more['emissions'][f]
+    return counts
+
+
+def chunks( items, n ):
+    ''' Split items into about n lists of consecutive items '''
+    size = max(1, int(math.ceil(len(items) / float(max(n, 1)))))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def quantiles( values, qs ):
+    ''' The qs-th percentiles (0-100) of values from a single sort, with the
+        same linear interpolation as numpy.percentile '''
+    values = numpy.sort(numpy.asarray(values, dtype=float))
+    pos = (len(values) - 1) * numpy.asarray(qs, dtype=float) / 100.0
+    lo = numpy.floor(pos).astype(int)
+    hi = numpy.minimum(lo + 1, len(values) - 1)
+    return list(values[lo] + (values[hi] - values[lo]) * (pos - lo))
+
+
+# Worker process state and functions for the multiprocessing pools below.
+# They live at module level so that they can be pickled.
+_workerLabeler = None
+
+def _initWorker( labeler ):
+    global _workerLabeler
+    _workerLabeler = labeler
+
+def _initQuietWorker( labeler ):
+    ''' _initWorker for workers whose output would only interleave, e.g.
+        the best path of every sketch from every fold '''
+    _initWorker(labeler)
+    sys.stdout = open(os.devnull, 'w')
+
+def _encodeStrokeFile( filename ):
+    ''' Load and featurefy an unlabeled file, return the encoded features '''
+    strokes = _workerLabeler.loadStrokeFile(filename)
+    features = _workerLabeler.featurefy(strokes)
+    _workerLabeler.hmm.featureIndices = _workerLabeler.featureIndices
+    return _workerLabeler.hmm.logModel().encode(features)
+
+def _expectedCounts( args ):
+    model, codesList = args
+    return model.expectedCounts(codesList)
+
+def _measureLabeledFile( filename ):
+    ''' Load a labeled file, return (raw features, labels) '''
+    strokes, labels = _workerLabeler.loadLabeledFile(filename)
+    return _workerLabeler.rawFeatures(strokes), labels
+
+_workerModel = None
+
+def _initModelWorker( model ):
+    global _workerModel
+    _workerModel = model
+
+def _segmentTransfer( args ):
+    ''' Decode one segment of a sequence (see LogModel.viterbiSegments) '''
+    evidence, first = args
+    return _workerModel.transfer(evidence, first)
+
+def _modelMethod( args ):
+    ''' Call a method of the worker's model: args is (name, arguments) '''
+    name, methodArgs = args
+    return getattr(_workerModel, name)(*methodArgs)
+
+def _runFold( args ):
+    ''' Train on one fold's training sketches and label its test sketches.
+        The sketches come as raw features, so bin edges (global or per
+        sketch) are learned from the fold's training sketches only. '''
+    fold, globalBins, trainRaw, trainLabels, testNames, testRaw, testLabels = args
+    labeler = _workerLabeler
+    start = time.time()
+    labeler.trainHMMRaw(trainRaw, trainLabels, globalBins)
+    trainTime = time.time() - start
+
+    start = time.time()
+    trueLabels = []
+    classifications = []
+    for raw, labels in zip(testRaw, testLabels):
+        edges = labeler.hmm.binEdges
+        if edges == None:
+            edges = labeler.binEdges(raw)
+        features = labeler.binFeatures(raw, edges)
+        labeler.hmm.featureIndices = labeler.featureIndices
+        trueLabels.extend(labels)
+        classifications.extend(labeler.hmm.label(features))
+    labelTime = time.time() - start
+
+    return {'fold': fold,
+            'trainFiles': len(trainRaw),
+            'testFiles': len(testRaw),
+            'tested': testNames,
+            'trainTime': trainTime,
+            'labelTime': labelTime,
+            'confusion': labeler.confusion(trueLabels, classifications)}
+
+
+class SketchArrays:
+    ''' The points of a sketch's strokes as flat numpy arrays, for the
+        vectorized feature kernels.  The points of stroke i are
+        xs[starts[i]:starts[i+1]] (likewise ys and ts).  The coordinates
+        are of the given dtype (float32 for compact labelers), the times
+        always float64 so that millisecond differences stay exact. '''
+
+    def __init__(self, strokes, dtype=float):
+        # read each stroke's points once, so lazily loaded strokes (see
+        # lazysketch.py) are decoded one at a time
+        perStroke = [numpy.asarray(s.points).reshape(-1, 3) for s in strokes]
+        counts = numpy.array([len(p) for p in perStroke], dtype=int)
+        self.starts = numpy.concatenate([[0], numpy.cumsum(counts)])
+        self.counts = counts
+        points = numpy.concatenate(perStroke) if perStroke else numpy.zeros((0, 3))
+        self.xs = points[:, 0].astype(dtype)
+        self.ys = points[:, 1].astype(dtype)
+        self.ts = points[:, 2].astype(float)
+
+    def numStrokes( self ):
+        return len(self.counts)
+
+    def strokeOfPoint( self ):
+        ''' The stroke number of every point '''
+        return numpy.repeat(numpy.arange(len(self.counts)), self.counts)
+
+
+# Feature kernels: each takes a SketchArrays and returns one raw value per stroke
+
+def lengthKernel( arrays ):
+    ''' Sum of the distances between consecutive points of each stroke '''
+    seg = numpy.zeros(len(arrays.xs), dtype=arrays.xs.dtype)
+    seg[:-1] = numpy.sqrt(numpy.diff(arrays.xs)**2 + numpy.diff(arrays.ys)**2)
+    seg[arrays.starts[1:] - 1] = 0   # the step from one stroke to the next
+    return numpy.add.reduceat(seg, arrays.starts[:-1])
+
+def meanXKernel( arrays ):
+    ''' Average x coordinate of each stroke '''
+    return numpy.add.reduceat(arrays.xs, arrays.starts[:-1]) / arrays.counts
+
+def bbAreaKernel( arrays ):
+    ''' Area of each stroke's bounding box '''
+    starts = arrays.starts[:-1]
+    width = numpy.maximum.reduceat(arrays.xs, starts) - numpy.minimum.reduceat(arrays.xs, starts)
+    height = numpy.maximum.reduceat(arrays.ys, starts) - numpy.minimum.reduceat(arrays.ys, starts)
+    return width * height
+
+def drawSpeedKernel( arrays ):
+    ''' Time per point of each stroke '''
+    return (arrays.ts[arrays.starts[1:] - 1] - arrays.ts[arrays.starts[:-1]]) / arrays.counts
+
+def nearestNeighborKernel( arrays, chunkSize=1<<22 ):
+    ''' Distance from the first point of each stroke to the closest point of
+        any other stroke (not counting the other strokes' first points) '''
+    loop = kernels.get('nearestNeighbor')
+    if loop is not None:
+        return loop(arrays.xs, arrays.ys, arrays.starts)
+    owner = arrays.strokeOfPoint()
+    others = numpy.ones(len(arrays.xs), dtype=bool)
+    others[arrays.starts[:-1]] = False
+    px = arrays.xs[others]
+    py = arrays.ys[others]
+    powner = owner[others]
+
+    N = arrays.numStrokes()
+    ret = numpy.empty(N)
+    ret.fill(1000000)
+    if len(px) == 0:
+        return ret
+    sx = arrays.xs[arrays.starts[:-1]]
+    sy = arrays.ys[arrays.starts[:-1]]
+    # strokes x points distance matrices, a block of strokes at a time
+    rows = max(1, chunkSize // len(px))
+    for i in range(0, N, rows):
+        dist = numpy.sqrt((sx[i:i+rows, None] - px)**2 + (sy[i:i+rows, None] - py)**2)
+        dist[numpy.arange(i, min(i+rows, N))[:, None] == powner] = numpy.inf
+        ret[i:i+rows] = numpy.minimum(ret[i:i+rows], dist.min(axis=1))
+    return ret
+
+def simplifyMask( xs, ys, starts, tolerance ):
+    ''' Douglas-Peucker simplification of every stroke of a sketch at once.
+        Returns a mask of the points to keep.  Each round measures every
+        point's distance to the chord between the kept points around it
+        and keeps the farthest point of every piece still farther than
+        tolerance, so all the strokes and pieces are split together, with
+        the same result as splitting them one at a time. '''
+    P = len(xs)
+    keep = numpy.zeros(P, dtype=bool)
+    counts = numpy.diff(starts)
+    keep[starts[:-1][counts > 0]] = True
+    keep[starts[1:][counts > 0] - 1] = True
+    index = numpy.arange(P)
+    while P > 0:
+        kept = numpy.flatnonzero(keep)
+        piece = numpy.searchsorted(kept, index, side='right') - 1
+        a = kept[piece]
+        b = kept[numpy.minimum(piece + 1, len(kept) - 1)]
+        dx = xs[b] - xs[a]
+        dy = ys[b] - ys[a]
+        px = xs - xs[a]
+        py = ys - ys[a]
+        chord = numpy.sqrt(dx**2 + dy**2)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            dist = numpy.where(chord > 0, numpy.abs(dx*py - dy*px) / chord,
+                               numpy.sqrt(px**2 + py**2))
+        dist[keep] = 0
+        far = numpy.maximum.reduceat(dist, kept)
+        split = far > tolerance
+        if not split.any():
+            break
+        # the first point of each piece at its largest distance
+        first = numpy.minimum.reduceat(numpy.where(dist == far[piece], index, P), kept)
+        keep[first[split]] = True
+    return keep
+
+def curvatureKernel( arrays ):
+    ''' Sum of the absolute curvature of each stroke divided by its number of
+        points, like Stroke.sumOfCurvature(abs) '''
+    loop = kernels.get('curvature')
+    if loop is not None:
+        return loop(arrays.xs, arrays.ys, arrays.starts)
+    owner = arrays.strokeOfPoint()
+    ax = arrays.xs[1:-1] - arrays.xs[:-2]
+    ay = arrays.ys[1:-1] - arrays.ys[:-2]
+    bx = arrays.xs[2:] - arrays.xs[1:-1]
+    by = arrays.ys[2:] - arrays.ys[1:-1]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        arg = (ax*bx + ay*by) / (numpy.sqrt(ax**2 + ay**2) * numpy.sqrt(bx**2 + by**2))
+    curv = numpy.arccos(numpy.clip(arg, -1.0, 1.0))
+    # only count point triples that lie inside one stroke
+    inside = (owner[:-2] == owner[2:])
+    curv = numpy.where(inside & ~numpy.isnan(curv), curv, 0)
+    sums = numpy.zeros(arrays.numStrokes())
+    numpy.add.at(sums, owner[:-2][inside], curv[inside])
+    return sums / arrays.counts
+
+
+class Feature:
+    ''' A stroke feature: its name, whether it is CONTINUOUS or DISCRETE, the
+        number of values it takes by default, the kernel that measures it and
+        how its raw values are binned (fixed edges, or percentiles of the
+        sketch's values) '''
+
+    def __init__(self, name, kernel, numVals, kind=DISCRETE, edges=None, percentiles=None):
+        self.name = name
+        self.kernel = kernel
+        self.numVals = numVals
+        self.kind = kind
+        self.edges = edges
+        self.percentiles = percentiles
+
+    def edgesFor( self, values, numVals=None ):
+        ''' The bin thresholds for these raw values.  Asking for a different
+            number of values than the default gives evenly spaced percentiles. '''
+        if numVals == None or numVals == self.numVals:
+            if self.edges != None:
+                return list(self.edges)
+            if self.percentiles != None:
+                return quantiles(values, self.percentiles)
+        return quantiles(values, [100.0 * i / numVals for i in range(1, numVals)])
+
+
+# All the features featurefy knows about, by name
+FEATURES = {}
+
+def registerFeature( feature ):
+    FEATURES[feature.name] = feature
+
+registerFeature(Feature('length', lengthKernel, 2, edges=[300]))
+registerFeature(Feature('nearest_neighbor_dist', nearestNeighborKernel, 2, percentiles=[50]))
+registerFeature(Feature('draw_speed', drawSpeedKernel, 4, percentiles=[25, 50, 75]))
+registerFeature(Feature('x', meanXKernel, 4, percentiles=[25, 50, 75]))
+registerFeature(Feature('bb_area', bbAreaKernel, 4, percentiles=[25, 50, 75]))
+registerFeature(Feature('curvature', curvatureKernel, 4, percentiles=[25, 50, 75]))
 
 
 class StrokeLabeler:
@@ -269,6 +1140,39 @@ class StrokeLabeler:
 
         #added field called featureIndices that will keep track of which feature option corresponds with which index
         self.featureIndices = {}
+        self.hmm = None
+        # 2 trains a second order transition model (see HMM.trainTransitions2)
+        self.order = 1
+
+        # With dedupe on, training and testing skip files whose contents
+        # were already seen (see uniqueFiles).  Either way trainingHashes
+        # are the content hashes of the files the HMM was last trained on,
+        # and testing warns about test files that were also trained on.
+        # The hashes are cached in hashIndex.cacheDir, not in the corpus.
+        self.dedupe = False
+        self.hashIndex = hashindex.HashIndex(os.path.join(os.path.expanduser('~'), '.strokehashes'))
+        self.trainingHashes = set()
+
+        # With segmentGap set (in milliseconds), labelStrokes cuts a sketch
+        # at every pen up gap longer than that and decodes the pieces
+        # separately, in segmentWorkers processes (see HMM.labelSegments).
+        # The labels are the same as decoding the whole sketch.
+        self.segmentGap = None
+        self.segmentWorkers = None
+        # With scanWorkers set, labelStrokes decodes with the parallel
+        # max-plus scan instead (see HMM.labelScan), for sketches with very
+        # many strokes.  Again the labels do not change.
+        self.scanWorkers = None
+
+        # A compact labeler stores stroke points as int32 arrays, times as
+        # offsets from the start of the sketch (see compactStrokes), measures
+        # features in float32 and labels with a float32 model.
+        self.compact = False
+
+        # With simplifyTolerance set, loading drops the points of each
+        # stroke that are within that distance of the polyline through the
+        # rest (Douglas-Peucker), so featurefy has fewer points to measure.
+        self.simplifyTolerance = None
         
         self.labelDict = {}
         for l in drawingLabels:
@@ -276,206 +1180,384 @@ class StrokeLabeler:
         for l in textLabels:
             self.labelDict[l] = 'text'
 
-        # Define the features to be used in the featurefy function
-        # if you change the featurefy function, you must also change
-        # these data structures.
-        # featureNames is just a list of all features.
-        # contOrDisc is a dictionary mapping each feature
-        #    name to whether it is continuous or discrete
-        # numFVals is a dictionary specifying the number of legal values for
-        #    each discrete feature
-        
-        # self.featureNames = ['x']
-        # self.contOrDisc = {'x' : DISCRETE}
-        # self.numFVals = {'x' : 4}
-        # self.numFVals = {'x' : 2}
-        # self.featureNames = ['draw_speed']
-        # self.contOrDisc = {'draw_speed' : DISCRETE}
-        # self.numFVals = {'draw_speed' : 4}
-
-        # self.featureNames = ['nearest_neighbor_dist']
-        # self.contOrDisc = {'nearest_neighbor_dist' : DISCRETE}
-        # self.numFVals = {'nearest_neighbor_dist' : 2}
-        
-        #all 5 features together
-        self.featureNames = ['length', 'nearest_neighbor_dist', 'draw_speed', 'x', 'bb_area']
-        self.contOrDisc = {'length': DISCRETE, 'nearest_neighbor_dist' : DISCRETE, 'draw_speed' : DISCRETE, 'x' : DISCRETE, 'bb_area' : DISCRETE}
-        self.numFVals = { 'length': 2, 'nearest_neighbor_dist' : 2, 'draw_speed' : 4, 'x' : 4, 'bb_area' : 4}
+        # Define the features to be used in the featurefy function.
+        # Every feature name must be registered in FEATURES (see
+        # registerFeature), which says whether it is continuous or discrete,
+        # how many values it takes and how to compute it.  setFeatures fills
+        # in featureNames, contOrDisc and numFVals from the registry;
+        # numFVals can be overridden per feature.
 
-        # self.featureNames = ['bb_area']
-        # self.contOrDisc = {'bb_area' : DISCRETE}
-        # self.numFVals = {'bb_area' : 4}
+        # self.setFeatures(['x'])
+        # self.setFeatures(['x'], {'x' : 2})
+        # self.setFeatures(['draw_speed'])
+        # self.setFeatures(['nearest_neighbor_dist'])
+        # self.setFeatures(['bb_area'])
+
+        #all 5 features together
+        self.setFeatures(['length', 'nearest_neighbor_dist', 'draw_speed', 'x', 'bb_area'])
+
+    def setFeatures( self, featureNames, numFVals=None ):
+        ''' Use the given registered features.  numFVals optionally maps
+            feature names to a number of bins other than the default. '''
+        self.featureNames = list(featureNames)
+        self.contOrDisc = {}
+        self.numFVals = {}
+        for f in self.featureNames:
+            self.contOrDisc[f] = FEATURES[f].kind
+            if FEATURES[f].kind == DISCRETE:
+                self.numFVals[f] = FEATURES[f].numVals
+        if numFVals != None:
+            self.numFVals.update(numFVals)
 
     def featurefy( self, strokes ):
         ''' Converts the list of strokes into a list of feature dictionaries
             suitable for the HMM
             The names of features used here have to match the names
-            passed into the HMM'''
+            passed into the HMM.
+            If the trained HMM stores global bin edges (see trainHMM) they
+            are used, otherwise the edges come from this sketch's strokes.'''
+        raw = self.rawFeatures(strokes)
+        edges = None
+        if self.hmm != None:
+            edges = self.hmm.binEdges
+        if edges == None:
+            edges = self.binEdges(raw)
+        return self.binFeatures(raw, edges)
+
+    def rawFeatures( self, strokes ):
+        ''' Measure the strokes.  Returns a dictionary mapping each feature
+            name in featureNames to the array of its raw (unbinned) values,
+            one per stroke.  Only the features in use are computed. '''
+        arrays = SketchArrays(strokes, self.floatDtype())
+        raw = {}
+        for f in self.featureNames:
+            with instrument.timer('featurefy.' + f):
+                raw[f] = FEATURES[f].kernel(arrays)
+        return raw
+
+    def floatDtype( self ):
+        ''' The dtype of measured features and model arrays '''
+        if self.compact:
+            return numpy.float32
+        return float
+
+    def binEdges( self, raw ):
+        ''' Work out the thresholds used to bin the raw feature values (see
+            rawFeatures).  Returns a dictionary mapping each discrete feature
+            name to its sorted list of thresholds. '''
+        edges = {}
+        for f in self.featureNames:
+            if self.contOrDisc[f] == DISCRETE:
+                edges[f] = FEATURES[f].edgesFor(raw[f], self.numFVals[f])
+        return edges
+
+    def binFeatures( self, raw, edges ):
+        ''' Bin the raw feature values with the given thresholds.  A value
+            gets bin i when it is at least the i-th threshold but less than
+            the next one.  Returns one feature dictionary per stroke. '''
         ret = []
-        d = {}  # The feature dictionary to be returned for one stroke
-
-        #creating a feature that calculates proximity to nearest neighbor
-        #This feature calculates the euclidean distance between starting location of stroke s and s2 and finds the smallest distance between
-        #s and any other s2. These distances were binned around the mean, with anything less being binned as a 0 and anything greater being binned
-        #as a 1.
-        sum_dist = 0
-        mean_dist = None
-        stroke_dist = []
-        draw_speed = []
-        sum_speed = 0
-        mean_speed = None
-        x_coord = []
-        bounding_box_area = []
-        for s in strokes: #loop through all strokes
-            closest_stroke_dist = 1000000
-            start_pt = s.points[0] #find the first pt
-            start_time = s.points[0][-1] #find the start time of a stroke
-            end_time = s.points[-1][-1] #find the end time
-            speed = (end_time - start_time)/float(len(s.points)) #find the actual time per point in the stroke
-            #print "Speed " + str(speed)
-            draw_speed.append(speed) #add it in
-            sum_speed += speed
-            xx = 0
-            #bounding box area calc
-            min_x = 1000000
-            max_x = -1000000
-            min_y = 1000000
-            max_y = -1000000
-            for k in range(len(s.points)):
-                #find the x and y coordinate of each point on the stroke
-                x = s.points[k][0]
-                y = s.points[k][1]
-                if x < min_x:
-                    min_x = x
-
-                if x > max_x:
-                    max_x = x
-
-                if y < min_y:
-                    min_y = y
-
-                if y > max_y:
-                    max_y = y
-                #check if its dimensions are larger/smaller than the max and min
-                xx += s.points[k][0]
-            x_coord.append(xx/float(len(s.points))) #add the average x coordinate to the list
-            bb_area = (max_y - min_y) * (max_x - min_x) #calc bounding box area and add to bb_area list
-            bounding_box_area.append(bb_area)
-    
-            for s2 in strokes: #loop through all strokes for tuples
-                if s != s2:
-                    max_idx = len(s2.points)
-                    for j in range(1,max_idx):
-                        s2_pt = s2.points[j]
-                        xdiff = start_pt[0] - s2_pt[0]
-                        ydiff = start_pt[1] - s2_pt[1]
-
-                        dist = math.sqrt(xdiff**2 + ydiff**2) #calculates distance
-                        if dist < closest_stroke_dist: #checks if its better than previous
-                            closest_stroke_dist = dist
-            sum_dist += closest_stroke_dist #sum the distances
-            stroke_dist.append(closest_stroke_dist) #add it to a list
-
-        mean_dist = sum_dist/len(strokes) #calculate the threshold/bin value
-
-        #calculates all the bin values
-        q1_speed = numpy.percentile(draw_speed, 25)
-        median_speed = numpy.percentile(draw_speed, 50)
-        q3_speed = numpy.percentile(draw_speed, 75)
-        mean_speed = sum_speed/len(strokes)
-        median_dist = numpy.percentile(stroke_dist, 50)
-        q1_x = numpy.percentile(x_coord, 25)
-        median_x = numpy.percentile(x_coord, 50)
-        q3_x = numpy.percentile(x_coord, 75)
-        q1_bb = numpy.percentile(bounding_box_area, 25)
-        bb_median = numpy.percentile(bounding_box_area, 50)
-        q3_bb = numpy.percentile(bounding_box_area, 75)
-        bb_mean = numpy.mean(bounding_box_area)           
-
-
-
-
-        #bin the features   
-        for i in range(len(strokes)):    
-            l = strokes[i].length()
-            if l < 300:
-                d['length'] = 0
-            else:
-                d['length'] = 1
-
-            dist = stroke_dist[i]
-            if dist < median_dist:
-                d['nearest_neighbor_dist'] = 0
-            else:
-                d['nearest_neighbor_dist'] = 1
-
-            sp = draw_speed[i]
-            if sp < q1_speed:
-                d['draw_speed'] = 0
-            elif sp < median_speed:
-                d['draw_speed'] = 1
-            elif sp < q3_speed:
-                d['draw_speed'] = 2
-            else:
-                d['draw_speed'] = 3
-
-            xxx = x_coord[i]
-            if xxx < q1_x:
-                d['x'] = 0
-            elif xxx < median_x:
-                d['x'] = 1
-            elif xxx < q3_x:
-                d['x'] = 2
-            else:
-                d['x'] = 3
-
-            bb = bounding_box_area[i]
-            if bb < q1_bb:
-                d['bb_area'] = 0
-            elif bb < bb_median:
-                d['bb_area'] = 1
-            elif bb < q3_bb:
-                d['bb_area'] = 2
+        values = {}
+        for f in self.featureNames:
+            if self.contOrDisc[f] == DISCRETE:
+                values[f] = [int(v) for v in numpy.searchsorted(edges[f], raw[f], side='right')]
             else:
-                d['bb_area'] = 3
-            
-
-
+                values[f] = [float(v) for v in raw[f]]
+        for i in range(len(raw[self.featureNames[0]])):
+            d = {}  # The feature dictionary to be returned for one stroke
+            for f in values:
+                d[f] = values[f][i]
             ret.append(d)  # append the feature dictionary to the list
 
         #adds the featureIndices of each feature
-        self.featureIndices['length'] = {0: 0, 1: 1}
-        self.featureIndices['nearest_neighbor_dist'] = {0: 0, 1: 1}
-        self.featureIndices['draw_speed'] = {0: 0, 1: 1, 2: 2, 3: 3}
-        self.featureIndices['x'] = {0: 0, 1: 1, 2: 2, 3: 3}
-        self.featureIndices['bb_area'] = {0: 0, 1: 1, 2: 2, 3: 3}
+        for f in edges:
+            self.featureIndices[f] = dict([(v, v) for v in range(len(edges[f]) + 1)])
         return ret
-    
-    def trainHMM( self, trainingFiles ):
-        ''' Train the HMM '''
-        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals )
+
+    def trainHMM( self, trainingFiles, globalBins=False ):
+        ''' Train the HMM.  With globalBins the feature bin edges are learned
+            once from all the training strokes and stored in the HMM, so
+            that labeling can bin each stroke without looking at the rest
+            of its sketch. '''
+        self.trainingHashes = set()
+        trainingFiles = list(self.uniqueFiles(trainingFiles, self.trainingHashes))
         allStrokes = []
         allLabels = []
         for f in trainingFiles:
             print "Loading file", f, "for training"
-            strokes, labels = self.loadLabeledFile( f )
+            with instrument.timer('loadLabeledFile'):
+                strokes, labels = self.loadLabeledFile( f )
             allStrokes.append(strokes)
             allLabels.append(labels)
-        allObservations = [self.featurefy(s) for s in allStrokes]
-        self.hmm.train(allObservations, allLabels)
+        allRaw = []
+        for s in allStrokes:
+            with instrument.timer('featurefy'):
+                allRaw.append(self.rawFeatures(s))
+        self.trainHMMRaw(allRaw, allLabels, globalBins)
+        instrument.count('files', len(trainingFiles))
+        instrument.count('strokes', sum([len(s) for s in allStrokes]))
+
+    def trainHMMRaw( self, allRaw, allLabels, globalBins=False ):
+        ''' Bin the raw features of each training sketch (see rawFeatures)
+            and train the HMM on them '''
+        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals, self.order )
+        self.hmm.dtype = self.floatDtype()
+        if globalBins:
+            pooled = {}
+            for f in allRaw[0]:
+                pooled[f] = numpy.concatenate([raw[f] for raw in allRaw])
+            self.hmm.binEdges = self.binEdges(pooled)
+        allObservations = []
+        for raw in allRaw:
+            edges = self.hmm.binEdges
+            if edges == None:
+                edges = self.binEdges(raw)
+            allObservations.append(self.binFeatures(raw, edges))
+        with instrument.timer('HMM.train'):
+            self.hmm.train(allObservations, allLabels)
+        self.hmm.featureIndices = self.featureIndices
+
+    def trainHMMStore( self, store, files=None, globalBins=False ):
+        ''' Train the HMM from the raw features cached in a FeatureStore
+            (see featurestore.py) instead of parsing the files again.
+            Only the columns of the features in use are read.  The store
+            must have been built with this labeler's load settings. '''
+        store.check(self)
+        if files == None:
+            files = store.files()
+        self.trainingHashes = set()
+        files = list(self.uniqueFiles(files, self.trainingHashes))
+        allRaw = [store.rawFeatures(f, self.featureNames) for f in files]
+        allLabels = [store.labels(f) for f in files]
+        self.trainHMMRaw(allRaw, allLabels, globalBins)
+
+    def labelStore( self, store, filename ):
+        ''' return the labels for the strokes of a file in a FeatureStore '''
+        store.check(self)
+        raw = store.rawFeatures(filename, self.featureNames)
+        edges = self.hmm.binEdges
+        if edges == None:
+            edges = self.binEdges(raw)
+        features = self.binFeatures(raw, edges)
+        self.hmm.featureIndices = self.featureIndices
+        return self.hmm.label(features)
 
-    def trainHMMDir( self, trainingDir ):
+    def trainHMMDir( self, trainingDir, globalBins=False ):
         ''' train the HMM on all the files in a training directory '''
-        for fFileObj in os.walk(trainingDir):
+        self.trainHMM(self.dirFiles(trainingDir), globalBins)
+
+    def trainHMMStream( self, trainingFiles, globalBins=False ):
+        ''' Train the HMM in about constant memory.  trainingFiles can be
+            any iterable, e.g. a generator; each sketch is loaded,
+            featurefied and folded into running label counts (see
+            HMM.countSketch), then thrown away.  The model is the same as
+            trainHMM on the same files.
+            With globalBins the thresholds need every training value before
+            any sketch can be binned, so the raw feature values (a few
+            numbers per stroke, no strokes) are kept until the end. '''
+        self.hmm = HMM( self.labels, self.featureNames, self.contOrDisc, self.numFVals, self.order )
+        self.hmm.dtype = self.floatDtype()
+        counts = self.hmm.emptyCounts()
+        kept = []
+        numFiles = 0
+        numStrokes = 0
+        self.trainingHashes = set()
+        for f in self.uniqueFiles(trainingFiles, self.trainingHashes):
+            print "Streaming file", f, "for training"
+            with instrument.timer('loadLabeledFile'):
+                strokes, labels = self.loadLabeledFile( f )
+            with instrument.timer('featurefy'):
+                raw = self.rawFeatures(strokes)
+            numFiles += 1
+            numStrokes += len(strokes)
+            del strokes
+            if globalBins:
+                kept.append((raw, labels))
+            else:
+                self.hmm.countSketch(counts, self.binFeatures(raw, self.binEdges(raw)), labels)
+
+        if globalBins:
+            pooled = {}
+            for f in self.featureNames:
+                pooled[f] = numpy.concatenate([raw[f] for raw, labels in kept])
+            self.hmm.binEdges = self.binEdges(pooled)
+            for raw, labels in kept:
+                self.hmm.countSketch(counts, self.binFeatures(raw, self.hmm.binEdges), labels)
+
+        with instrument.timer('HMM.train'):
+            self.hmm.maximize(counts)
+        self.hmm.featureIndices = self.featureIndices
+        print "HMM trained on", numFiles, "streamed files"
+        instrument.count('files', numFiles)
+        instrument.count('strokes', numStrokes)
+
+    def trainHMMStreamDir( self, trainingDir, globalBins=False ):
+        ''' stream the files of a training directory into trainHMMStream '''
+        self.trainHMMStream(self.iterDirFiles(trainingDir), globalBins)
+
+    def refineHMM( self, strokeFiles, iterations=10, workers=None, tolerance=1e-4 ):
+        ''' Refine the trained HMM on unlabeled stroke files with Baum-Welch (EM).
+            Files are featurefied once, then every iteration fans the E step
+            out over a pool of worker processes and sums their expected
+            counts for the M step.  Stops after iterations rounds, or once
+            the average log likelihood per sketch improves by less than
+            tolerance.  Returns the log likelihood of each iteration. '''
+        if self.hmm == None:
+            print "HMM must be trained first"
+            return []
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        strokeFiles = list(self.uniqueFiles(strokeFiles))
+        pool = multiprocessing.Pool(workers, _initWorker, (self,))
+        try:
+            print "Featurefying", len(strokeFiles), "files for Baum-Welch"
+            allCodes = pool.map(_encodeStrokeFile, strokeFiles)
+            history = []
+            for it in range(iterations):
+                model = self.hmm.logModel()
+                counts = None
+                for more in pool.imap_unordered(_expectedCounts,
+                        [(model, c) for c in chunks(allCodes, workers*4)]):
+                    counts = addCounts(counts, more)
+                self.hmm.maximize(counts)
+                history.append(counts['logLikelihood'])
+                print "Baum-Welch iteration", it, "log likelihood is", counts['logLikelihood']
+                if it > 0 and (history[-1] - history[-2]) / len(allCodes) < tolerance:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        return history
+
+    def refineHMMDir( self, strokeDir, iterations=10, workers=None ):
+        ''' refine the HMM on all the files in a directory of unlabeled sketches '''
+        return self.refineHMM(self.dirFiles(strokeDir), iterations, workers)
+
+    def crossValidate( self, directory, k=5, workers=None, globalBins=False ):
+        ''' k-fold cross validation over the labeled files in a directory.
+            Every file is loaded and measured once (in parallel), file i
+            goes in fold i % k, and the folds are trained and tested in
+            parallel worker processes, each binning with edges learned from
+            its own training files (see trainHMM for globalBins).  Returns a
+            dictionary with the summed 'confusion' matrix, the overall
+            'accuracy', the 'featurefyTime' and the per fold results in
+            'folds', each listing the files it 'tested'. '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        files = list(self.uniqueFiles(self.dirFiles(directory)))
+        k = min(k, len(files))
+        pool = multiprocessing.Pool(workers, _initQuietWorker, (self,))
+        try:
+            start = time.time()
+            data = pool.map(_measureLabeledFile, files)
+            featurefyTime = time.time() - start
+
+            tasks = []
+            for fold in range(k):
+                train = [i for i in range(len(data)) if i % k != fold]
+                test = [i for i in range(len(data)) if i % k == fold]
+                tasks.append((fold, globalBins,
+                              [data[i][0] for i in train], [data[i][1] for i in train],
+                              [files[i] for i in test],
+                              [data[i][0] for i in test], [data[i][1] for i in test]))
+            folds = pool.map(_runFold, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        total = {l: {l2: 0 for l2 in self.labels} for l in self.labels}
+        for result in folds:
+            for t in self.labels:
+                for c in self.labels:
+                    total[t][c] += result['confusion'][t][c]
+        right = sum([total[l][l] for l in self.labels])
+        allCount = sum([sum(total[l].values()) for l in self.labels])
+
+        print "Cross validation confusion matrix is: " + str(total)
+        for result in folds:
+            print "Fold", result['fold'], "trained in", result['trainTime'], \
+                  "s, labeled in", result['labelTime'], "s"
+        return {'confusion': total,
+                'accuracy': right / float(max(allCount, 1)),
+                'featurefyTime': featurefyTime,
+                'folds': folds}
+
+    def testHMM( self, testFiles ):
+        ''' Label the labeled test files with the trained HMM and compare.
+            With dedupe on, duplicate test files are counted once.  Test
+            files that the HMM was also trained on are always reported.
+            Returns a dictionary with the 'confusion' matrix, the 'accuracy'
+            and the 'leaked' files. '''
+        testFiles = list(self.uniqueFiles(testFiles))
+        leaked = self.leakedFiles(testFiles)
+        trueLabels = []
+        classifications = []
+        for f in testFiles:
+            strokes, labels = self.loadLabeledFile( f )
+            trueLabels.extend(labels)
+            classifications.extend(self.labelStrokes(strokes))
+        total = self.confusion(trueLabels, classifications)
+        right = sum([total[l][l] for l in self.labels])
+        return {'confusion': total,
+                'accuracy': right / float(max(len(trueLabels), 1)),
+                'leaked': leaked}
+
+    def testHMMDir( self, testDir ):
+        ''' test the HMM on all the files in a directory of labeled sketches '''
+        return self.testHMM(self.dirFiles(testDir))
+
+    def uniqueFiles( self, files, hashes=None ):
+        ''' Yield the files whose contents have not been seen before,
+            skipping exact copies (see hashindex.py), or all the files when
+            self.dedupe is off.  The content hash of every file yielded is
+            added to hashes, if given. '''
+        if not self.dedupe and hashes is None:
+            for f in files:
+                yield f
+            return
+        seen = {}
+        try:
+            for f in files:
+                h = self.hashIndex.fingerprint(f)
+                if self.dedupe and h in seen:
+                    print "Skipping", f, "(same contents as", seen[h] + ")"
+                    instrument.count('duplicates')
+                    continue
+                seen[h] = f
+                if hashes is not None:
+                    hashes.add(h)
+                yield f
+        finally:
+            self.hashIndex.save()
+
+    def leakedFiles( self, testFiles ):
+        ''' return the test files whose contents the HMM was trained on,
+            warning about each one '''
+        leaked = [f for f in testFiles if self.hashIndex.fingerprint(f) in self.trainingHashes]
+        self.hashIndex.save()
+        for f in leaked:
+            print "WARNING: test file", f, "was also a training file"
+        if leaked:
+            print "WARNING:", len(leaked), "of", len(testFiles), "test files were trained on"
+        return leaked
+
+    def dirFiles( self, directory ):
+        ''' return the paths of all the non-hidden files in a directory '''
+        for fFileObj in os.walk(directory):
             lFileList = fFileObj[2]
             break
         goodList = []
         for x in lFileList:
             if not x.startswith('.'):
                 goodList.append(x)
-        
-        tFiles = [ trainingDir + "/" + f for f in goodList ] 
-        self.trainHMM(tFiles)
+
+        return [ directory + "/" + f for f in goodList ]
+
+    def iterDirFiles( self, directory ):
+        ''' yield the paths of the non-hidden files in a directory one at a
+            time, like dirFiles '''
+        for f in os.listdir(directory):
+            if not f.startswith('.') and os.path.isfile(os.path.join(directory, f)):
+                yield directory + "/" + f
 
     def featureTest( self, strokeFile ):
         ''' Loads a stroke file and tests the feature functions '''
@@ -491,19 +1573,38 @@ class StrokeLabeler:
         ''' Label the strokes in the file strokeFile and save the labels
             (with the strokes) in the outFile '''
         print "Labeling file", strokeFile
-        strokes = self.loadStrokeFile( strokeFile )
-        labels = self.labelStrokes( strokes )
-        print "Labeling done, saving file as", outFile
-        self.saveFile( strokes, labels, strokeFile, outFile )
+        with instrument.timer('labelFile'):
+            with instrument.timer('loadStrokeFile'):
+                strokes = self.loadStrokeFile( strokeFile )
+            labels = self.labelStrokes( strokes )
+            print "Labeling done, saving file as", outFile
+            with instrument.timer('saveFile'):
+                self.saveFile( strokes, labels, strokeFile, outFile )
+        instrument.count('files')
+        instrument.count('strokes', len(strokes))
 
     def labelStrokes( self, strokes ):
         ''' return a list of labels for the given list of strokes '''
         if self.hmm == None:
             print "HMM must be trained first"
             return []
-        strokeFeatures = self.featurefy(strokes)
+        with instrument.timer('featurefy'):
+            strokeFeatures = self.featurefy(strokes)
         self.hmm.featureIndices = self.featureIndices
-        return self.hmm.label(strokeFeatures)
+        self.hmm.dtype = self.floatDtype()
+        with instrument.timer('HMM.label'):
+            if self.segmentGap != None:
+                return self.hmm.labelSegments(strokeFeatures, self.gapStarts(strokes),
+                                              self.segmentWorkers)
+            if self.scanWorkers != None:
+                return self.hmm.labelScan(strokeFeatures, self.scanWorkers)
+            return self.hmm.label(strokeFeatures)
+
+    def gapStarts( self, strokes ):
+        ''' The positions of the strokes that begin more than segmentGap
+            milliseconds after the stroke before them ended '''
+        return [i for i in range(1, len(strokes))
+                if strokes[i].startTime() - strokes[i-1].endTime() > self.segmentGap]
 
 
     def confusion(self, trueLabels, classifications):
@@ -540,7 +1641,8 @@ class StrokeLabeler:
             in an XML format that can be visualized by the labeler.
             Need to input the original file from which the strokes were read
             so that we can retrieve a lot of data that we don't store here'''
-        sketch = xml.dom.minidom.parse(originalFile)
+        with instrument.timer('saveFile.parse'):
+            sketch = xml.dom.minidom.parse(originalFile)
         # copy most of the data, including all points, substrokes, strokes
         # then just add the shapes onto the end
         impl =  xml.dom.minidom.getDOMImplementation()
@@ -554,25 +1656,30 @@ class StrokeLabeler:
 
         # Now add all the children from sketch as long as they are points, strokes
         # or substrokes
+        # Take the children off in order: appendChild would remove each one
+        # from sketchElem with a search past all the nodes left in front of
+        # it, which is quadratic in the number of points
         sketchElem = sketch.getElementsByTagName("sketch")[0]
-        for child in sketchElem.childNodes:
+        for child in list(sketchElem.childNodes):
+            sketchElem.removeChild(child)
             if child.nodeType == xml.dom.Node.ELEMENT_NODE:
                 if child.tagName == "point":
                     top_element.appendChild(child)
                 elif child.tagName == "shape":
                     if child.getAttribute("type") == "substroke" or \
                        child.getAttribute("type") == "stroke":
-                        top_element.appendChild(child)    
+                        top_element.appendChild(child)
 
         # Finally, add the new elements for the labels
+        ids = guid.thread_generator().generate_batch(len(strokes))
         for i in range(len(strokes)):
             # make a new element
             newElem = newdoc.createElement("shape")
             # Required attributes are type, name, id and time
             newElem.setAttribute("type", labels[i])
             newElem.setAttribute("name", "shape")
-            newElem.setAttribute("id", guid.generate() )
-            newElem.setAttribute("time", str(strokes[i].points[-1][2]))  # time is finish time
+            newElem.setAttribute("id", ids[i] )
+            newElem.setAttribute("time", str(strokes[i].endTime()))  # time is finish time
 
             # Now add the children
             for ss in strokes[i].substrokeIds:
@@ -585,18 +1692,21 @@ class StrokeLabeler:
             
 
         # Write to the file
-        filehandle = open(outFile, "w")
-        newdoc.writexml(filehandle)
-        filehandle.close()
+        with instrument.timer('saveFile.write'):
+            filehandle = open(outFile, "w")
+            newdoc.writexml(filehandle)
+            filehandle.close()
 
         # unlink the docs
         newdoc.unlink()
         sketch.unlink()
 
-    def loadStrokeFile( self, filename ):
+    def loadStrokeFile( self, filename, prepare=True ):
         ''' Read in a file containing strokes and return a list of stroke
-            objects '''
-        sketch = xml.dom.minidom.parse(filename)
+            objects.  Unless prepare is False the strokes are simplified
+            and compacted as set up (see prepareStrokes). '''
+        with instrument.timer('parse'):
+            sketch = xml.dom.minidom.parse(filename)
         # get the points
         points = sketch.getElementsByTagName("point")
         pointsDict = self.buildDict(points)
@@ -608,25 +1718,63 @@ class StrokeLabeler:
         strokes = []
         for shape in allShapes:
             if shape.getAttribute("type") == "stroke":
-                strokes.append(self.buildStroke( shape, shapesDict, pointsDict ))
+                with instrument.timer('buildStroke'):
+                    strokes.append(self.buildStroke( shape, shapesDict, pointsDict ))
 
         # I THINK the strokes will be loaded in order, but make sure
         if not self.verifyStrokeOrder(strokes):
             print "WARNING: Strokes out of order"
 
         sketch.unlink()
+        if prepare:
+            self.prepareStrokes(strokes)
         return strokes
 
+    def prepareStrokes( self, strokes ):
+        ''' The load time steps the labeler is set up for: simplify the
+            strokes (simplifyTolerance), then store them compactly '''
+        if self.simplifyTolerance != None:
+            with instrument.timer('simplify'):
+                self.simplifyStrokes(strokes)
+        if self.compact:
+            self.compactStrokes(strokes)
+
+    def simplifyStrokes( self, strokes ):
+        ''' Drop the points of each stroke that Douglas-Peucker with
+            simplifyTolerance would (see simplifyMask) '''
+        arrays = SketchArrays(strokes)
+        keep = simplifyMask(arrays.xs, arrays.ys, arrays.starts, self.simplifyTolerance)
+        for i, s in enumerate(strokes):
+            mask = keep[arrays.starts[i]:arrays.starts[i+1]]
+            if isinstance(s.points, numpy.ndarray):
+                s.points = s.points[mask]
+            else:
+                s.points = [p for p, k in zip(s.points, mask) if k]
+        instrument.count('points.simplified', len(keep) - int(keep.sum()))
+
+    def compactStrokes( self, strokes ):
+        ''' Replace the strokes' lists of point tuples by int32 arrays, with
+            times stored as offsets from the first time in the sketch (kept
+            in each stroke's timeBase) '''
+        if len(strokes) == 0:
+            return
+        base = min([s.startTime() for s in strokes])
+        for s in strokes:
+            points = numpy.array(s.points, dtype=numpy.int64).reshape(-1, 3)
+            points[:, 2] -= base - s.timeBase
+            s.points = points.astype(numpy.int32)
+            s.timeBase = base
+
     def verifyStrokeOrder( self, strokes ):
         ''' returns True if all of the strokes are temporally ordered,
             False otherwise. '''
         time = 0
         ret = True
         for s in strokes:
-            if s.points[0][2] < time:
+            if s.startTime() < time:
                 ret = False
                 break
-            time = s.points[0][2]
+            time = s.startTime()
         return ret
 
     def buildDict( self, nodesWithIdAttrs ):
@@ -669,13 +1817,16 @@ class StrokeLabeler:
                     points.append((x, y, time))
                     last = (x, y, time)
         ret.setPoints(points)
+        instrument.count('points', len(points))
         return ret
                 
 
-    def loadLabeledFile( self, filename ):
+    def loadLabeledFile( self, filename, prepare=True ):
         ''' load the strokes and the labels for the strokes from a labeled file.
-            return the strokes and the labels as a tuple (strokes, labels) '''
-        sketch = xml.dom.minidom.parse(filename)
+            return the strokes and the labels as a tuple (strokes, labels).
+            prepare is as for loadStrokeFile. '''
+        with instrument.timer('parse'):
+            sketch = xml.dom.minidom.parse(filename)
         # get the points
         points = sketch.getElementsByTagName("point")
         pointsDict = self.buildDict(points)
@@ -688,8 +1839,9 @@ class StrokeLabeler:
         substrokeIdDict = {}
         for shape in allShapes:
             if shape.getAttribute("type") == "stroke":
-                stroke = self.buildStroke( shape, shapesDict, pointsDict )
-                strokes.append(self.buildStroke( shape, shapesDict, pointsDict ))
+                with instrument.timer('buildStroke'):
+                    stroke = self.buildStroke( shape, shapesDict, pointsDict )
+                strokes.append(stroke)
                 substrokeIdDict[stroke.strokeId] = stroke
             else:
                 # If it's a shape, then just store the label on the substrokes
@@ -719,17 +1871,23 @@ class StrokeLabeler:
             strokes.remove(stroke)
             
         sketch.unlink()
+        if prepare:
+            self.prepareStrokes(strokes)
         if len(strokes) != len(labels):
             print "PROBLEM: number of strokes and labels must match"
             print "numStrokes is", len(strokes), "numLabels is", len(labels)
         return strokes, labels
 
+def identity( x ):
+    return x
+
 class Stroke:
     ''' A class to represent a stroke (series of xyt points).
         This class also has various functions for computing stroke features. '''
     def __init__(self, strokeId):
         self.strokeId = strokeId
         self.substrokeIds = []   # Keep around the substroke ids for writing back to file
+        self.timeBase = 0        # added to the times in points (see StrokeLabeler.compactStrokes)
         
     def __repr__(self):
         ''' Return a string representation of the stroke '''
@@ -743,6 +1901,14 @@ class Stroke:
         ''' Set the points for the stroke '''
         self.points = points
 
+    def startTime( self ):
+        ''' The time of the stroke's first point '''
+        return int(self.points[0][2]) + self.timeBase
+
+    def endTime( self ):
+        ''' The time of the stroke's last point '''
+        return int(self.points[-1][2]) + self.timeBase
+
 
     # Feature functions follow this line
     def length( self ):
@@ -759,13 +1925,17 @@ class Stroke:
 
 
 
-    def sumOfCurvature(self, func=lambda x: x, skip=1):
+    def sumOfCurvature(self, func=identity, skip=1):
         ''' Return the normalized sum of curvature for a stroke.
             func is a function to apply to the curvature before summing
                 e.g., to find the sum of absolute value of curvature,
                 you could pass in abs
             skip is a smoothing constant (how many points to skip)
         '''
+        loop = kernels.get('sumOfCurvature')
+        if loop is not None and (func is abs or func is identity):
+            points = numpy.array(self.points, dtype=float).reshape(-1, 3)
+            return loop(points[:, 0], points[:, 1], skip, func is abs)
         if len(self.points) < 2*skip+1:
             return 0
         ret = 0
@@ -810,9 +1980,10 @@ class Stroke:
     # You can (and should) define more features here
 
 
-def test_trainHMM():
+def seaweedHMM():
     '''
     Part 1 Viterbi Testing Example: Dry, Dryish, Damp, Soggy Seaweed Example
+    Returns the hand-built HMM and the test sequence
     '''
     test_states = ['Sunny', 'Cloudy', 'Rainy']
     test_features = ['Wetness']
@@ -834,8 +2005,746 @@ def test_trainHMM():
 
     #Dry will be the 0th index of the features list, Dry's index will be 1, etc.
     test_hmm.featureIndices['Wetness'] = {'Dry': 0, 'Dryish': 1, 'Damp': 2, 'Soggy': 3}
+    return test_hmm, test_sequence
+
+def test_trainHMM():
+    test_hmm, test_sequence = seaweedHMM()
     return test_hmm.label(test_sequence)
 
+def test_kBestHMM():
+    '''
+    The best of the k best paths must be the Viterbi path, and the k best
+    must match brute force enumeration of all 27 paths of the seaweed example
+    '''
+    test_hmm, test_sequence = seaweedHMM()
+    kbest = test_hmm.labelKBest(test_sequence, 5)
+    assert kbest[0][1] == test_hmm.label(test_sequence)
+
+    allPaths = []
+    for s0 in test_hmm.states:
+        for s1 in test_hmm.states:
+            for s2 in test_hmm.states:
+                path = [s0, s1, s2]
+                prob = test_hmm.priors[s0]
+                for t in range(3):
+                    if t > 0:
+                        prob *= test_hmm.transitions[path[t-1]][path[t]]
+                    index = test_hmm.featureIndices['Wetness'][test_sequence[t]['Wetness']]
+                    prob *= test_hmm.emissions[path[t]]['Wetness'][index]
+                allPaths.append((prob, path))
+    allPaths.sort(reverse=True)
+    for (score, path), (prob, bruteForce) in zip(kbest, allPaths):
+        assert abs(math.exp(score) - prob) < 1e-12
+        assert path == bruteForce
+    return kbest
+
+def test_logViterbi():
+    '''
+    Viterbi on the log model must find the most probable of all 27 paths
+    of the seaweed example, with the log of its probability, and
+    HMM.label must return that path
+    '''
+    test_hmm, test_sequence = seaweedHMM()
+    model = test_hmm.logModel()
+    score, path = model.viterbi(model.logEvidence(model.encode(test_sequence)))
+    path = [test_hmm.states[s] for s in path]
+    assert path == test_hmm.label(test_sequence)
+
+    best = (0, None)
+    for s0 in test_hmm.states:
+        for s1 in test_hmm.states:
+            for s2 in test_hmm.states:
+                candidate = [s0, s1, s2]
+                prob = test_hmm.priors[s0]
+                for t in range(3):
+                    if t > 0:
+                        prob *= test_hmm.transitions[candidate[t-1]][candidate[t]]
+                    index = test_hmm.featureIndices['Wetness'][test_sequence[t]['Wetness']]
+                    prob *= test_hmm.emissions[candidate[t]]['Wetness'][index]
+                best = max(best, (prob, candidate))
+    assert path == best[1]
+    assert abs(math.exp(score) - best[0]) < 1e-12
+    return path
+
+def test_compiledKernels():
+    '''
+    The compiled kernels must give bit-identical results to the NumPy code
+    on the bundled sketches (skipped when numba is not installed)
+    '''
+    import unittest
+    import benchmark
+    if not kernels.COMPILED:
+        raise unittest.SkipTest('numba is not installed')
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    files = sorted(sl.dirFiles(os.path.join(data, 'trainingFiles')))[:5]
+    calls = benchmark.kernelCalls([sl.loadLabeledFile(f)[0] for f in files])
+    saved = kernels.backend
+    try:
+        for name in sorted(calls):
+            kernels.use('numpy')
+            expected = calls[name]()
+            kernels.use('numba')
+            assert benchmark.sameResults(calls[name](), expected), name
+    finally:
+        kernels.use(saved)
+    return sorted(calls)
+
+def test_viterbiSegments():
+    '''
+    Decoding a sequence in segments and joining them must give exactly the
+    Viterbi path and score, wherever the cuts are
+    '''
+    test_hmm, test_sequence = seaweedHMM()
+    model = test_hmm.logModel()
+    evidence = numpy.log(numpy.random.RandomState(0).dirichlet([1, 1, 1], 200))
+    score, path = model.viterbi(evidence)
+    for starts in [[], [1], [199], [50, 51, 120], range(0, 200, 7)]:
+        segScore, segPath = model.viterbiSegments(evidence, starts)
+        assert segPath == path
+        assert abs(segScore - score) < 1e-9
+    return path
+
+def test_viterbiScan():
+    '''
+    The max-plus scan decoder must give exactly the Viterbi path and score,
+    for any number of blocks
+    '''
+    test_hmm, test_sequence = seaweedHMM()
+    model = test_hmm.logModel()
+    evidence = numpy.log(numpy.random.RandomState(0).dirichlet([1, 1, 1], 300))
+    score, path = model.viterbi(evidence)
+    for blocks in [1, 2, 7, 300]:
+        scanScore, scanPath = model.viterbiScan(evidence, blocks=blocks)
+        assert scanPath == path
+        assert abs(scanScore - score) < 1e-9
+    return path
+
+def test_compactLabels():
+    '''
+    A compact labeler (int32 points, float32 features and model) must give
+    the same labels as the default one on the bundled test sketches, and
+    write the same stroke times
+    '''
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    labelers = []
+    for compact in [False, True]:
+        sl = StrokeLabeler()
+        sl.compact = compact
+        sl.trainHMMDir(os.path.join(data, 'trainForResults'))
+        labelers.append(sl)
+    for f in labelers[0].dirFiles(os.path.join(data, 'testForResults')):
+        strokes = [sl.loadStrokeFile(f) for sl in labelers]
+        assert [s.endTime() for s in strokes[0]] == [s.endTime() for s in strokes[1]]
+        assert strokes[1][0].points.dtype == numpy.int32
+        assert labelers[0].labelStrokes(strokes[0]) == labelers[1].labelStrokes(strokes[1])
+    return labelers
+
+def test_longSketchLabels():
+    '''
+    On a generated sketch long enough for path probabilities to underflow,
+    decoding in segments, with the max-plus scan and with a compact model
+    must all give the labels of plain labelStrokes
+    '''
+    import shutil, tempfile
+    import sketchgen
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    tmpDir = tempfile.mkdtemp()
+    try:
+        sketch = os.path.join(tmpDir, 'long.labeled.xml')
+        sketchgen.generateSketch(sketch, 1000, seed=0)
+        sl = StrokeLabeler()
+        sl.trainHMMDir(os.path.join(data, 'trainForResults'))
+        strokes, trueLabels = sl.loadLabeledFile(sketch)
+        labels = sl.labelStrokes(strokes)
+        assert 0 < labels.count('text') < len(labels)
+
+        sl.segmentGap = 1000
+        assert sl.labelStrokes(strokes) == labels
+        sl.segmentGap = None
+        sl.scanWorkers = 2
+        assert sl.labelStrokes(strokes) == labels
+        sl.scanWorkers = None
+        sl.compact = True
+        assert sl.labelStrokes(sl.loadLabeledFile(sketch)[0]) == labels
+    finally:
+        shutil.rmtree(tmpDir)
+    return labels
+
+def test_saveFile():
+    '''
+    saveFile must copy every point, substroke and stroke of the original
+    in order and add one shape per stroke with its label, also when there
+    is no whitespace between the elements
+    '''
+    import re, shutil, tempfile
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    original = StrokeLabeler().dirFiles(os.path.join(data, 'testForResults'))[0]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        packed = os.path.join(tmpDir, 'packed.xml')
+        text = open(original).read()
+        with open(packed, 'w') as f:
+            f.write(re.sub(r'>\s+<', '><', text))
+
+        def copied(sketch):
+            return [(e.tagName, e.getAttribute('id'))
+                    for e in sketch.documentElement.childNodes
+                    if e.nodeType == xml.dom.Node.ELEMENT_NODE and
+                       (e.tagName == 'point' or e.getAttribute('type') in ('substroke', 'stroke'))]
+        expected = copied(xml.dom.minidom.parse(original))
+
+        sl = StrokeLabeler()
+        for source in [original, packed]:
+            strokes = sl.loadStrokeFile(source)
+            labels = ['text' if i % 2 else 'drawing' for i in range(len(strokes))]
+            out = os.path.join(tmpDir, 'out.xml')
+            sl.saveFile(strokes, labels, source, out)
+            saved = xml.dom.minidom.parse(out)
+            assert copied(saved) == expected
+            shapes = [e for e in saved.getElementsByTagName('shape')
+                      if e.getAttribute('type') in ('text', 'drawing')]
+            assert [e.getAttribute('type') for e in shapes] == labels
+            assert [[a.firstChild.data for a in e.getElementsByTagName('arg')] for e in shapes] == \
+                   [s.substrokeIds for s in strokes]
+    finally:
+        shutil.rmtree(tmpDir)
+    return expected
+
+def test_simplifyMask():
+    '''
+    The vectorized Douglas-Peucker must keep the same points as the
+    recursive one, stroke by stroke, on random strokes of all lengths
+    (including empty, one and two point strokes and closed loops)
+    '''
+    def recursive(xs, ys, keep, a, b, tolerance):
+        if b - a < 2:
+            return
+        dx, dy = xs[b] - xs[a], ys[b] - ys[a]
+        chord = math.sqrt(dx**2 + dy**2)
+        best, far = -1, 0
+        for i in range(a + 1, b):
+            px, py = xs[i] - xs[a], ys[i] - ys[a]
+            if chord > 0:
+                d = abs(dx*py - dy*px) / chord
+            else:
+                d = math.sqrt(px**2 + py**2)
+            if d > far:
+                best, far = i, d
+        if far > tolerance:
+            keep[best] = True
+            recursive(xs, ys, keep, a, best, tolerance)
+            recursive(xs, ys, keep, best, b, tolerance)
+
+    rand = numpy.random.RandomState(0)
+    for trial in range(20):
+        counts = list(rand.randint(0, 60, size=8)) + [0, 1, 2]
+        rand.shuffle(counts)
+        starts = numpy.concatenate([[0], numpy.cumsum(counts)])
+        xs = numpy.cumsum(rand.randint(-5, 6, size=starts[-1])).astype(float)
+        ys = numpy.cumsum(rand.randint(-5, 6, size=starts[-1])).astype(float)
+        if counts[0] > 1:
+            xs[counts[0] - 1], ys[counts[0] - 1] = xs[0], ys[0]    # a closed loop
+        for tolerance in [0, 0.5, 2, 8]:
+            expected = numpy.zeros(len(xs), dtype=bool)
+            for i in range(len(counts)):
+                if counts[i] > 0:
+                    expected[starts[i]] = expected[starts[i+1] - 1] = True
+                    recursive(xs, ys, expected, starts[i], starts[i+1] - 1, tolerance)
+            assert (simplifyMask(xs, ys, starts, tolerance) == expected).all()
+    return expected
+
+def test_pointCache():
+    '''
+    Delta encoded points must decode to the points of the strokes, with
+    their timeBase added, for several strokes with small and large steps,
+    an empty stroke, compact strokes and with and without compression, and
+    a cached sketch must load the same strokes as the file
+    '''
+    import shutil, tempfile
+    import pointcache
+    rand = numpy.random.RandomState(0)
+    strokes = []
+    for i, (n, step) in enumerate([(5, 3), (0, 1), (40, 200), (1, 1), (30, 100000)]):
+        stroke = Stroke(str(i))
+        xy = numpy.cumsum(rand.randint(-step, step + 1, size=(n, 2)), axis=0) + 5000
+        times = 1157434265766 + 8 * numpy.arange(n) + 1000 * i
+        stroke.setPoints([(int(x), int(y), int(t)) for (x, y), t in zip(xy, times)])
+        strokes.append(stroke)
+    # compactStrokes needs every stroke to have a first point
+    compact = copy.deepcopy([s for s in strokes if len(s.points)])
+    StrokeLabeler().compactStrokes(compact)
+    assert compact[0].timeBase != 0
+    empty = Stroke('empty')
+    empty.setPoints(numpy.zeros((0, 3), dtype=numpy.int32))
+    empty.timeBase = compact[0].timeBase
+    compact.insert(1, empty)
+
+    for sketch in [strokes, compact]:
+        expected = numpy.concatenate([numpy.array(s.points, dtype=numpy.int64).reshape(-1, 3) +
+                                      [0, 0, s.timeBase] for s in sketch])
+        for compress in [True, False]:
+            fields, payload = pointcache.encodePoints(sketch, compress)
+            points, starts = pointcache.decodePoints(fields, payload)
+            assert (points == expected).all()
+            assert list(numpy.diff(starts)) == [len(s.points) for s in sketch]
+
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sketchFile = StrokeLabeler().dirFiles(os.path.join(data, 'testForResults'))[0]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        sl = StrokeLabeler()
+        sl.compact = True
+        fromFile, labels = sl.loadLabeledFile(sketchFile)
+        for attempt in ['miss', 'hit']:
+            cache = pointcache.PointCache(tmpDir, sl)
+            cached, cachedLabels = cache.loadLabeledFile(sketchFile)
+            assert cachedLabels == labels
+            assert [s.substrokeIds for s in cached] == [s.substrokeIds for s in fromFile]
+            assert [s.endTime() for s in cached] == [s.endTime() for s in fromFile]
+            for a, b in zip(cached, fromFile):
+                assert numpy.array_equal(a.points, b.points)
+    finally:
+        shutil.rmtree(tmpDir)
+    return points
+
+def test_guidBatch():
+    '''
+    guid.generate_batch(n) must give the same guids as n calls to
+    generate() from the same state, continue the counter of the guids
+    before it, wrap the counter around and move on to the next
+    millisecond when the counters run out, keeping every guid unique and
+    in time order
+    '''
+    import random
+    class Clock:
+        ''' Stands in for the time module: the time only moves on sleep '''
+        def __init__(self):
+            self.now = 1157434265.766
+        def time(self):
+            return self.now
+        def sleep(self, seconds):
+            self.now += 0.001
+
+    def counterOf(g):
+        return int(g[19:23] + g[24:28], 16)
+    def timeOf(g):
+        return g[0:18]
+
+    saved = (guid.time, guid.counter, guid.firstcounter, guid.lasttime)
+    try:
+        guid.time = Clock()
+        state = (guid.counter, guid.firstcounter, guid.lasttime)
+        random.seed(1)
+        batch = guid.generate_batch(10)
+        guid.counter, guid.firstcounter, guid.lasttime = state
+        random.seed(1)
+        assert [guid.generate() for i in range(10)] == batch
+
+        mixed = [guid.generate()] + guid.generate_batch(5) + [guid.generate()] + guid.generate_batch(3)
+        ids = batch + mixed
+        counters = [counterOf(g) for g in ids]
+        assert counters == range(counters[0], counters[0] + len(ids))
+        assert len(set(timeOf(g) for g in ids)) == 1
+        assert sorted(ids) == ids
+
+        # the counter wraps around past MAX_COUNTER
+        guid.counter = guid.MAX_COUNTER - 2
+        wrapped = guid.generate_batch(3) + [guid.generate()] + guid.generate_batch(2)
+        assert [counterOf(g) for g in wrapped] == [guid.MAX_COUNTER - 1, guid.MAX_COUNTER, 0, 1, 2, 3]
+
+        # only 3 counters are left in this millisecond, so the rest of the
+        # batch comes from the next one
+        guid.firstcounter = guid.counter + 3
+        start = guid.counter
+        random.seed(2)
+        spill = guid.generate_batch(5)
+        assert [counterOf(g) for g in spill[:3]] == [start + 1, start + 2, start + 3]
+        assert timeOf(spill[3]) > timeOf(spill[2]) == timeOf(wrapped[0])
+        assert counterOf(spill[4]) == counterOf(spill[3]) + 1
+
+        everything = ids + wrapped + spill
+        assert len(set(everything)) == len(everything)
+        assert [timeOf(g) for g in everything] == sorted([timeOf(g) for g in everything])
+    finally:
+        guid.time, guid.counter, guid.firstcounter, guid.lasttime = saved
+    return everything
+
+def test_guidThreads():
+    '''
+    Per-thread Generators in several threads at once, each making more
+    guids than fit in one millisecond, must never make the same guid
+    twice, and each thread's guids must come out in order
+    '''
+    import threading
+    results = {}
+    def work(n):
+        g = guid.thread_generator()
+        ids = g.generate_batch(guid.Generator.MAX_COUNTER + 1000)
+        ids += [g.generate() for i in range(100)] + g.generate_batch(500)
+        results[n] = (g, ids)
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(set([id(g) for g, ids in results.values()])) == len(threads)
+    everything = []
+    for g, ids in results.values():
+        assert len(ids) > guid.Generator.MAX_COUNTER
+        assert sorted(ids) == ids
+        everything.extend(ids)
+    assert len(set(everything)) == len(everything)
+    return everything
+
+def test_quantiles():
+    '''
+    quantiles must match numpy.percentile, for random values, a single
+    value, values with ties and all equal values, at the bin thresholds
+    the features use and at the ends
+    '''
+    rand = numpy.random.RandomState(0)
+    qs = [0, 12.5, 25, 100.0 / 3, 50, 66.7, 75, 99.9, 100]
+    for values in [rand.normal(size=101), rand.exponential(size=8), [4.5],
+                   [1, 2, 2, 2, 3, 3, 7], [5, 5, 5, 5], rand.randint(0, 3, size=50)]:
+        expected = [numpy.percentile(values, q) for q in qs]
+        got = quantiles(values, qs)
+        assert len(got) == len(qs)
+        for a, b in zip(got, expected):
+            assert abs(a - b) <= 1e-12 * max(1, abs(b))
+    return got
+
+def test_instrument():
+    '''
+    While enabled, timers and counters must record every stage and count
+    and report them with the right statistics; while disabled, timer must
+    hand back NULL_TIMER and nothing must be recorded
+    '''
+    import StringIO
+    class Clock:
+        ''' Stands in for the time module: each call returns the next time '''
+        def __init__(self, times):
+            self.times = list(times)
+        def time(self):
+            return self.times.pop(0)
+
+    saved = (instrument.time, instrument.enabled, instrument.callback,
+             dict(instrument.samples), dict(instrument.counters))
+    try:
+        instrument.disable()
+        instrument.reset()
+        assert instrument.timer('stage') is instrument.NULL_TIMER
+        with instrument.timer('stage'):
+            instrument.count('points', 5)
+        assert instrument.stats() == {'stages': {}, 'counters': {}}
+
+        timings = []
+        instrument.enable(lambda name, seconds: timings.append((name, seconds)))
+        instrument.time = Clock([0.0, 1.0, 10.0, 12.0, 20.0, 23.0, 30.0, 34.0])
+        for i in range(4):
+            with instrument.timer('stage'):
+                instrument.count('points', 5)
+        instrument.count('files')
+        assert timings == [('stage', 1), ('stage', 2), ('stage', 3), ('stage', 4)]
+
+        stats = instrument.stats()
+        assert stats['counters'] == {'points': 20, 'files': 1}
+        stage = stats['stages']['stage']
+        assert (stage['calls'], stage['total'], stage['mean'], stage['max']) == (4, 10, 2.5, 4)
+        for key, q in [('p50', 50), ('p90', 90), ('p99', 99)]:
+            assert abs(stage[key] - numpy.percentile([1, 2, 3, 4], q)) < 1e-12
+        out = StringIO.StringIO()
+        instrument.report(out)
+        assert 'stage' in out.getvalue() and 'points' in out.getvalue()
+
+        instrument.disable()
+        assert instrument.timer('stage') is instrument.NULL_TIMER
+        instrument.count('files')
+        assert instrument.stats() == stats
+    finally:
+        instrument.time, instrument.enabled, instrument.callback = saved[:3]
+        instrument.reset()
+        instrument.samples.update(saved[3])
+        instrument.counters.update(saved[4])
+    return stats
+
+def test_secondOrderHMM():
+    '''
+    Second order Viterbi on a longer seaweed sequence must find the same
+    best path as brute force enumeration of all 3^6 paths, and the second
+    order k best list the same best paths and probabilities
+    '''
+    test_hmm, test_sequence = seaweedHMM()
+    test_sequence = test_sequence + [{'Wetness': 'Dryish'}, {'Wetness': 'Soggy'}, {'Wetness': 'Dry'}]
+    test_hmm.order = 2
+    test_hmm.trainTransitions2(None, [['Sunny', 'Sunny', 'Cloudy', 'Rainy', 'Rainy', 'Sunny'],
+                                      ['Rainy', 'Cloudy', 'Cloudy', 'Sunny']])
+    best = test_hmm.label(test_sequence)
+
+    def pathProb(path):
+        prob = test_hmm.priors[path[0]]
+        for t in range(len(path)):
+            if t == 1:
+                prob *= test_hmm.transitions[path[0]][path[1]]
+            if t > 1:
+                prob *= test_hmm.transitions2[path[t-2]][path[t-1]][path[t]]
+            index = test_hmm.featureIndices['Wetness'][test_sequence[t]['Wetness']]
+            prob *= test_hmm.emissions[path[t]]['Wetness'][index]
+        return prob
+
+    paths = [[]]
+    for t in range(len(test_sequence)):
+        paths = [p + [s] for p in paths for s in test_hmm.states]
+    bruteForce = max(paths, key=pathProb)
+    assert best == bruteForce
+
+    kbest = test_hmm.labelKBest(test_sequence, 10)
+    ranked = sorted(paths, key=pathProb, reverse=True)
+    assert kbest[0][1] == best
+    # compare probabilities, since paths of equal probability can come in
+    # either order
+    for (score, path), bruteForce in zip(kbest, ranked):
+        assert abs(math.exp(score) - pathProb(path)) < 1e-12
+        assert abs(math.exp(score) - pathProb(bruteForce)) < 1e-12
+    assert len(set([tuple(path) for score, path in kbest])) == 10
+    return best
+
+def test_countSketch():
+    '''
+    Counting sketches one at a time and calling maximize must give the same
+    model as train on all of them, for discrete and continuous features
+    '''
+    states = ['drawing', 'text']
+    features = ['size', 'speed']
+    contOrDisc = {'size': DISCRETE, 'speed': CONTINUOUS}
+    numVals = {'size': 3}
+    data = [[{'size': 0, 'speed': 1.5}, {'size': 2, 'speed': 0.5}, {'size': 1, 'speed': 2.0}],
+            [{'size': 2, 'speed': 0.25}, {'size': 2, 'speed': 1.0}, {'size': 0, 'speed': 3.0},
+             {'size': 1, 'speed': 0.75}]]
+    labels = [['drawing', 'text', 'drawing'], ['text', 'text', 'drawing', 'text']]
+
+    batch = HMM(states, features, contOrDisc, numVals, 2)
+    batch.train(data, labels)
+    stream = HMM(states, features, contOrDisc, numVals, 2)
+    counts = stream.emptyCounts()
+    for d, l in zip(data, labels):
+        stream.countSketch(counts, d, l)
+    stream.maximize(counts)
+
+    for s in states:
+        assert abs(batch.priors[s] - stream.priors[s]) < 1e-12
+        for s1 in states:
+            assert abs(batch.transitions[s][s1] - stream.transitions[s][s1]) < 1e-12
+            for s2 in states:
+                assert abs(batch.transitions2[s][s1][s2] - stream.transitions2[s][s1][s2]) < 1e-12
+        for f in features:
+            for x, y in zip(batch.emissions[s][f], stream.emissions[s][f]):
+                assert abs(x - y) < 1e-12
+    return stream
+
+def test_refineHMM():
+    '''
+    maximize on the one-hot counts of labeled sketches must give the model
+    train gives, Baum-Welch on unlabeled sketches must never lower the log
+    likelihood, and a state that is never followed by another must get
+    uniform transitions instead of nan
+    '''
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    sketches = [sl.loadLabeledFile(f)
+                for f in sorted(sl.dirFiles(os.path.join(data, 'trainForResults')))[:6]]
+    observations = [sl.featurefy(strokes) for strokes, labels in sketches]
+    allLabels = [labels for strokes, labels in sketches]
+    sl.hmm = HMM(sl.labels, sl.featureNames, sl.contOrDisc, sl.numFVals)
+    sl.hmm.train(observations, allLabels)
+    sl.hmm.featureIndices = sl.featureIndices
+
+    counted = HMM(sl.labels, sl.featureNames, sl.contOrDisc, sl.numFVals)
+    counts = counted.emptyCounts()
+    for d, l in zip(observations, allLabels):
+        counted.countSketch(counts, d, l)
+    counted.maximize(counts)
+    for s in sl.labels:
+        assert abs(sl.hmm.priors[s] - counted.priors[s]) < 1e-12
+        for s1 in sl.labels:
+            assert abs(sl.hmm.transitions[s][s1] - counted.transitions[s][s1]) < 1e-12
+        for f in sl.featureNames:
+            for x, y in zip(sl.hmm.emissions[s][f], counted.emissions[s][f]):
+                assert abs(x - y) < 1e-12
+
+    unlabeled = sorted(sl.dirFiles(os.path.join(data, 'testForResults')))[:6]
+    history = sl.refineHMM(unlabeled, 5, 2, -numpy.inf)
+    assert len(history) == 5
+    for before, after in zip(history, history[1:]):
+        assert after >= before - 1e-9 * abs(before)
+
+    counts['transitions'][0] = 0
+    counted.maximize(counts)
+    assert counted.transitions[sl.labels[0]] == dict([(s, 0.5) for s in sl.labels])
+    return history
+
+def test_lazySketch():
+    '''
+    Strokes loaded lazily with a tiny maxResidentPoints, plain and
+    simplified, must have the points and get the labels of the strokes
+    loadStrokeFile loads, while holding few points at a time
+    '''
+    import lazysketch
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    sl.trainHMM(sorted(sl.dirFiles(os.path.join(data, 'trainForResults')))[:5])
+    maxResident = 20
+    for tolerance in [None, 2]:
+        sl.simplifyTolerance = tolerance
+        for f in sorted(sl.dirFiles(os.path.join(data, 'testForResults')))[:3]:
+            eager = sl.loadStrokeFile(f)
+            sketch = lazysketch.LazySketch(f, maxResident, tolerance)
+            lazy = sketch.strokes
+            assert [s.strokeId for s in lazy] == [s.strokeId for s in eager]
+            assert [(s.startTime(), s.endTime()) for s in lazy] == \
+                   [(s.startTime(), s.endTime()) for s in eager]
+            largest = 0
+            for s, e in zip(lazy, eager):
+                assert [tuple(p) for p in s.points] == [tuple(p) for p in e.points]
+                largest = max(largest, len(e.points))
+                assert sketch.residentPoints <= max(maxResident, largest)
+            assert sl.labelStrokes(lazy) == sl.labelStrokes(eager)
+            assert sketch.residentPoints <= max(maxResident, largest)
+            assert not all([s.isLoaded() for s in lazy])
+            sketch.close()
+    return sketch
+
+def test_crossValidate():
+    '''
+    The folds must test every file exactly once, and the summed confusion
+    matrix must count every stroke once
+    '''
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testForResults')
+    sl = StrokeLabeler()
+    files = sl.dirFiles(directory)
+    result = sl.crossValidate(directory, k=4, workers=2)
+
+    tested = []
+    for fold in result['folds']:
+        assert fold['trainFiles'] + fold['testFiles'] == len(files)
+        assert fold['testFiles'] == len(fold['tested'])
+        tested.extend(fold['tested'])
+    assert sorted(tested) == sorted(files)
+
+    strokes = sum([len(sl.loadLabeledFile(f)[1]) for f in files])
+    total = result['confusion']
+    assert sum([total[t][c] for t in sl.labels for c in sl.labels]) == strokes
+    return result
+
+def test_duplicateFiles():
+    '''
+    A training file copied under another name must be reported as leaked
+    when it is tested, and skipped when training with dedupe on
+    '''
+    import shutil, tempfile
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    trainFiles = sorted(sl.dirFiles(os.path.join(data, 'trainForResults')))[:5]
+    testFile = sorted(sl.dirFiles(os.path.join(data, 'testForResults')))[0]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        sl.hashIndex = hashindex.HashIndex(os.path.join(tmpDir, 'hashes'))
+        copy = os.path.join(tmpDir, 'copy.labeled.xml')
+        shutil.copy(trainFiles[2], copy)
+
+        sl.trainHMM(trainFiles)
+        result = sl.testHMM([testFile, copy])
+        assert result['leaked'] == [copy]
+
+        sl.dedupe = True
+        assert list(sl.uniqueFiles(trainFiles + [copy])) == trainFiles
+        sl.trainHMM([copy] + trainFiles)
+        assert sl.testHMM([testFile, trainFiles[2]])['leaked'] == [trainFiles[2]]
+        # the hashes are cached in hashIndex.cacheDir, not next to the copy
+        assert sorted(os.listdir(tmpDir)) == ['copy.labeled.xml', 'hashes']
+    finally:
+        shutil.rmtree(tmpDir)
+    return result
+
+def test_featureStore():
+    '''
+    A FeatureStore reopened from disk must train the same model and give
+    the same labels as the files themselves, and must refuse a labeler
+    that loads strokes differently and files listed twice
+    '''
+    import shutil, tempfile
+    import featurestore
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    files = sorted(sl.dirFiles(os.path.join(data, 'trainForResults')))[:4]
+    tmpDir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpDir, 'corpus.store')
+        assert featurestore.FeatureStore(path).build(files, sl) == len(files)
+        store = featurestore.FeatureStore(path)
+        assert store.files() == files
+        assert store.build(files, sl) == 0
+
+        sl.trainHMM(files[:3])
+        expected = sl.labelStrokes(sl.loadStrokeFile(files[3]))
+        sl.trainHMMStore(store, files[:3])
+        assert sl.labelStore(store, files[3]) == expected
+        assert store.labels(files[3]) == sl.loadLabeledFile(files[3])[1]
+
+        sl.simplifyTolerance = 2
+        try:
+            sl.labelStore(store, files[3])
+            assert False, 'the store was built without simplification'
+        except ValueError:
+            pass
+        assert store.build(files, sl) == len(files)
+        assert featurestore.FeatureStore(path).settings()['simplifyTolerance'] == 2
+
+        try:
+            store.build(files + files[:1], sl)
+            assert False, 'a file was listed twice'
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmpDir)
+    return store
+
+def test_featureSearch():
+    '''
+    Searching feature subsets in worker processes must score every
+    candidate the way evaluate does on its own, and pick the cheapest
+    candidate that reaches the target accuracy
+    '''
+    import shutil, tempfile
+    import featuresearch, featurestore
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sl = StrokeLabeler()
+    files = sorted(sl.dirFiles(os.path.join(data, 'trainingFiles')))[:6]
+    names = sorted(FEATURES)[:3]
+    costs = dict([(f, float(i + 1)) for i, f in enumerate(sorted(FEATURES))])
+    tmpDir = tempfile.mkdtemp()
+    try:
+        store = featurestore.FeatureStore(os.path.join(tmpDir, 'corpus.store'))
+        store.build(files, sl)
+        splits = featuresearch.folds(files, k=3)
+        candidateList = featuresearch.candidates(names, [1, 2], [2, 3])
+        results = featuresearch.search(store, candidateList, splits, 2, False, costs)
+        assert len(results) == len(candidateList)
+        assert [r['cost'] for r in results] == sorted([r['cost'] for r in results])
+
+        target = sorted([r['accuracy'] for r in results])[len(results) // 2]
+        best = featuresearch.cheapest(results, target)
+        assert best['accuracy'] >= target
+        assert all([r['cost'] >= best['cost'] for r in results if r['accuracy'] >= target])
+        alone = featuresearch.evaluate((best['features'], best['bins']), store, splits, False)
+        assert (alone['right'], alone['strokes']) == (best['right'], best['strokes'])
+        assert alone['accuracy'] == best['accuracy']
+        assert best['strokes'] == sum([len(store.labels(f)) for f in files])
+    finally:
+        shutil.rmtree(tmpDir)
+    return best
+
 
 ##############CODE FOR RESULTS.TXT AND CONFUSION MATRIX##############
 # sl = StrokeLabeler()
@@ -0,0 +1,404 @@
+#Benchmarks for the stroke labeling pipeline
+#-------------------------------------------------
+# Times each stage of StrokeHmm separately (loadLabeledFile, featurefy,
+# HMM.train, HMM.label and saveFile) over a directory of labeled sketches
+# and writes the results as JSON so runs can be compared across commits.
+#
+# usage: python benchmark.py [-d ../trainingFiles] [-o results.json]
+#                            [--compare old.json] [--synthetic 100,1000,10000]
+#                            [--kernels] [--simplify 0.5,1,2,4]
+
+import argparse
+import copy
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import StrokeHmm
+import kernels
+import sketchgen
+
+STAGES = ['load', 'featurefy', 'train', 'label', 'save']
+
+
+class Quiet:
+    ''' Context manager that sends stdout to /dev/null, so the progress
+        printing in StrokeHmm does not end up in the timings output '''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def procStatusKB(field):
+    ''' A memory figure from /proc/self/status (Linux only), or None '''
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(field + r':\s+(\d+) kB', f.read())
+    except IOError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def peakMemoryKB():
+    ''' Peak resident memory of this process, in kilobytes: since the last
+        resetPeakMemory where that works, otherwise since it started '''
+    peak = procStatusKB('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024   # bytes on OS X, kilobytes on Linux
+    return peak
+
+
+def resetPeakMemory():
+    ''' Start peakMemoryKB again from the memory in use now.  Only Linux can
+        do this (see clear_refs in proc(5)); returns False elsewhere. '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+class StagePeak:
+    ''' Context manager measuring the memory of one stage.  Where the high
+        water mark can be reset, peakKB is the stage's own peak and growthKB
+        how far it rose above the memory in use when the stage began.
+        Elsewhere peakKB is the process's peak so far and growthKB how far
+        the stage pushed it up, 0 if the stage stayed below an earlier peak. '''
+    def __enter__(self):
+        if resetPeakMemory():
+            self.start = procStatusKB('VmRSS')
+        else:
+            self.start = peakMemoryKB()
+        return self
+
+    def __exit__(self, *exc):
+        self.peakKB = peakMemoryKB()
+        self.growthKB = max(0, self.peakKB - self.start)
+
+
+def stageResult(seconds, points, strokes, memory):
+    return {'seconds': seconds,
+            'pointsPerSec': points / seconds if seconds > 0 else None,
+            'strokesPerSec': strokes / seconds if seconds > 0 else None,
+            'peakMemoryKB': memory.peakKB,
+            'memoryGrowthKB': memory.growthKB}
+
+
+def gitCommit():
+    ''' The commit being benchmarked, or None outside a git checkout '''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks(files):
+    ''' Run every stage over the given labeled files and return the results.
+        Each stage is timed and its memory measured on its own (see
+        StagePeak). '''
+    sl = StrokeHmm.StrokeLabeler()
+
+    start = time.time()
+    with StagePeak() as memory:
+        with Quiet():
+            loaded = [sl.loadLabeledFile(f) for f in files]
+    loadTime = time.time() - start
+
+    numStrokes = sum([len(strokes) for strokes, labels in loaded])
+    numPoints = sum([len(s.points) for strokes, labels in loaded for s in strokes])
+
+    results = {}
+    results['load'] = stageResult(loadTime, numPoints, numStrokes, memory)
+
+    start = time.time()
+    with StagePeak() as memory:
+        observations = [sl.featurefy(strokes) for strokes, labels in loaded]
+    results['featurefy'] = stageResult(time.time() - start, numPoints, numStrokes, memory)
+
+    start = time.time()
+    with StagePeak() as memory:
+        with Quiet():
+            sl.hmm = StrokeHmm.HMM(sl.labels, sl.featureNames, sl.contOrDisc, sl.numFVals)
+            sl.hmm.train(observations, [labels for strokes, labels in loaded])
+    results['train'] = stageResult(time.time() - start, numPoints, numStrokes, memory)
+
+    sl.hmm.featureIndices = sl.featureIndices
+    start = time.time()
+    with StagePeak() as memory:
+        with Quiet():
+            predicted = [sl.hmm.label(features) for features in observations]
+    results['label'] = stageResult(time.time() - start, numPoints, numStrokes, memory)
+
+    outDir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        with StagePeak() as memory:
+            for i in range(len(files)):
+                outFile = os.path.join(outDir, os.path.basename(files[i]))
+                sl.saveFile(loaded[i][0], predicted[i], files[i], outFile)
+        results['save'] = stageResult(time.time() - start, numPoints, numStrokes, memory)
+    finally:
+        shutil.rmtree(outDir)
+
+    return {'commit': gitCommit(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'files': len(files),
+            'strokes': numStrokes,
+            'points': numPoints,
+            'stages': results}
+
+
+# Run in a fresh interpreter: count name lookups while StrokeHmm is imported
+IMPORT_SCRIPT = """
+import json, socket, sys, time
+sys.path.insert(0, %r)
+calls = []
+for name in ['getaddrinfo', 'gethostbyname', 'gethostbyname_ex', 'gethostbyaddr']:
+    def counted(*args, **kwargs):
+        calls.append(args)
+        raise socket.error('name lookups are not allowed while importing')
+    setattr(socket, name, counted)
+start = time.time()
+import StrokeHmm
+print json.dumps({'seconds': time.time() - start, 'resolverCalls': len(calls)})
+"""
+
+
+def benchImport():
+    ''' Time importing StrokeHmm in a new process and count the host name
+        lookups it makes (there should be none, guid resolves lazily) '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % here])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def runScaling(sizes, meanPoints=20):
+    ''' Benchmark synthetic sketches (see sketchgen.py) with the given numbers
+        of strokes, one sketch per size, to see how each stage scales '''
+    tmpDir = tempfile.mkdtemp()
+    try:
+        ret = []
+        for size, filename in sketchgen.generateSizes(tmpDir, sizes, meanPoints):
+            results = runBenchmarks([filename])
+            results['size'] = size
+            ret.append(results)
+        return ret
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def kernelCalls(sketches):
+    ''' One function per compiled kernel, running it over all the sketches
+        through the StrokeHmm code that dispatches to it '''
+    arrays = [StrokeHmm.SketchArrays(strokes) for strokes in sketches]
+    model = StrokeHmm.seaweedHMM()[0].logModel()
+    evidence = numpy.log(numpy.random.RandomState(0).dirichlet([1, 1, 1], 100000))
+    return {'viterbi': lambda: model.viterbi(evidence),
+            'nearestNeighbor': lambda: [StrokeHmm.nearestNeighborKernel(a) for a in arrays],
+            'curvature': lambda: [StrokeHmm.curvatureKernel(a) for a in arrays],
+            'sumOfCurvature': lambda: [s.sumOfCurvature(abs) for strokes in sketches
+                                       for s in strokes]}
+
+
+def sameResults(a, b):
+    ''' True if two kernel results are bit for bit the same '''
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all([sameResults(x, y) for x, y in zip(a, b)])
+    return numpy.array_equal(a, b)
+
+
+def benchKernels(files):
+    ''' Time every kernel with the NumPy code and, if numba is installed,
+        the compiled loops, and check that both give identical results.
+        The compiled kernels are run once before timing so compilation is
+        not counted. '''
+    with Quiet():
+        sketches = [StrokeHmm.StrokeLabeler().loadLabeledFile(f)[0] for f in files]
+    calls = kernelCalls(sketches)
+    backends = ['numpy'] + (['numba'] if kernels.COMPILED else [])
+    saved = kernels.backend
+    ret = {}
+    try:
+        for name in sorted(calls):
+            ret[name] = {}
+            outputs = {}
+            for backend in backends:
+                kernels.use(backend)
+                outputs[backend] = calls[name]()
+                start = time.time()
+                calls[name]()
+                ret[name][backend] = time.time() - start
+            if 'numba' in outputs:
+                ret[name]['identical'] = sameResults(outputs['numpy'], outputs['numba'])
+    finally:
+        kernels.use(saved)
+    return ret
+
+
+def reportKernels(results):
+    if not kernels.COMPILED:
+        print "numba is not installed, only the NumPy kernels were timed"
+    print "%-16s %10s %10s %8s %10s" % ('kernel', 'numpy (s)', 'numba (s)', 'speedup', 'identical')
+    for name in sorted(results):
+        r = results[name]
+        if 'numba' in r:
+            print "%-16s %10.3f %10.3f %8.1f %10s" % (name, r['numpy'], r['numba'],
+                                                      r['numpy'] / max(r['numba'], 1e-9), r['identical'])
+        else:
+            print "%-16s %10.3f %10s %8s %10s" % (name, r['numpy'], '-', '-', '-')
+
+
+def simplifyReport(trainFiles, testFiles, tolerances):
+    ''' Train on trainFiles and label testFiles with the strokes simplified
+        at each tolerance (None is no simplification).  The files are parsed
+        once and every tolerance simplifies a copy of the strokes.  Returns
+        one result per tolerance with the number of points, the time to
+        simplify, the time to measure the features of all the strokes and
+        the test accuracy. '''
+    sl = StrokeHmm.StrokeLabeler()
+    with Quiet():
+        train = [sl.loadLabeledFile(f, False) for f in trainFiles]
+        test = [sl.loadLabeledFile(f, False) for f in testFiles]
+    ret = []
+    for tolerance in tolerances:
+        sl.simplifyTolerance = tolerance
+        trainStrokes = copy.deepcopy([strokes for strokes, labels in train])
+        testStrokes = copy.deepcopy([strokes for strokes, labels in test])
+        start = time.time()
+        for strokes in trainStrokes + testStrokes:
+            sl.prepareStrokes(strokes)
+        simplifyTime = time.time() - start
+        start = time.time()
+        allRaw = [sl.rawFeatures(strokes) for strokes in trainStrokes + testStrokes]
+        featurefyTime = time.time() - start
+        allRaw = allRaw[:len(trainStrokes)]
+
+        trueLabels = []
+        predicted = []
+        with Quiet():
+            sl.trainHMMRaw(allRaw, [labels for strokes, labels in train])
+            for strokes, (original, labels) in zip(testStrokes, test):
+                trueLabels.extend(labels)
+                predicted.extend(sl.labelStrokes(strokes))
+        right = sum([t == p for t, p in zip(trueLabels, predicted)])
+        ret.append({'tolerance': tolerance,
+                    'points': sum([len(s.points) for strokes in trainStrokes + testStrokes
+                                   for s in strokes]),
+                    'simplifySeconds': simplifyTime,
+                    'featurefySeconds': featurefyTime,
+                    'accuracy': right / float(max(len(trueLabels), 1))})
+    return ret
+
+
+def reportSimplify(results):
+    print "%-10s %10s %14s %14s %10s" % ('tolerance', 'points', 'simplify (s)', 'featurefy (s)',
+                                         'accuracy')
+    for r in results:
+        print "%-10s %10d %14.3f %14.3f %10.4f" % (r['tolerance'], r['points'], r['simplifySeconds'],
+                                                   r['featurefySeconds'], r['accuracy'])
+
+
+def compare(old, new):
+    ''' Print the per stage time and memory growth of new relative to old '''
+    print "%-10s %10s %10s %8s %12s %12s" % ('stage', 'old (s)', 'new (s)', 'ratio',
+                                            'old +KB', 'new +KB')
+    for stage in STAGES:
+        if stage not in old['stages'] or stage not in new['stages']:
+            continue
+        o = old['stages'][stage]['seconds']
+        n = new['stages'][stage]['seconds']
+        # results from before memoryGrowthKB was measured have no growth
+        oKB = old['stages'][stage].get('memoryGrowthKB')
+        nKB = new['stages'][stage].get('memoryGrowthKB')
+        print "%-10s %10.3f %10.3f %8.2f %12s %12s" % (stage, o, n, n / o if o > 0 else float('nan'),
+                                                      '-' if oKB is None else oKB,
+                                                      '-' if nKB is None else nKB)
+
+
+def report(results):
+    print "%d files, %d strokes, %d points" % (results['files'], results['strokes'], results['points'])
+    print "%-10s %10s %14s %14s %12s %12s" % ('stage', 'seconds', 'points/sec', 'strokes/sec',
+                                              'peak KB', 'growth KB')
+    for stage in STAGES:
+        r = results['stages'][stage]
+        print "%-10s %10.3f %14.0f %14.1f %12d %12d" % (stage, r['seconds'], r['pointsPerSec'] or 0,
+                                                        r['strokesPerSec'] or 0, r['peakMemoryKB'],
+                                                        r['memoryGrowthKB'])
+    if 'import' in results:
+        print "import StrokeHmm took %.3f s with %d host name lookups" % \
+              (results['import']['seconds'], results['import']['resolverCalls'])
+
+
+def reportScaling(scaling):
+    print "%-10s %10s" % ('strokes', 'points') + ''.join(["%11s" % stage for stage in STAGES])
+    for results in scaling:
+        print "%-10d %10d" % (results['strokes'], results['points']) + \
+              ''.join(["%11.3f" % results['stages'][stage]['seconds'] for stage in STAGES])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stroke labeling pipeline')
+    parser.add_argument('-d', '--dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           '..', 'trainingFiles'),
+                        help='directory of labeled sketches to benchmark on')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--synthetic', help='also time synthetic sketches with these comma '
+                                            'separated numbers of strokes')
+    parser.add_argument('--kernels', action='store_true',
+                        help='also compare the NumPy and compiled (numba) kernels')
+    parser.add_argument('--simplify', help='report the accuracy and featurefy time of '
+                                           'simplifying strokes at these comma separated '
+                                           'tolerances, training on --train and testing on --test')
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--train', default=os.path.join(here, '..', 'trainForResults'))
+    parser.add_argument('--test', default=os.path.join(here, '..', 'testForResults'))
+    args = parser.parse_args(argv)
+
+    files = StrokeHmm.StrokeLabeler().dirFiles(args.dir)
+    results = runBenchmarks(files)
+    results['import'] = benchImport()
+    report(results)
+    if args.synthetic:
+        results['scaling'] = runScaling([int(n) for n in args.synthetic.split(',')])
+        reportScaling(results['scaling'])
+    if args.kernels:
+        results['kernels'] = benchKernels(files)
+        reportKernels(results['kernels'])
+    if args.simplify:
+        sl = StrokeHmm.StrokeLabeler()
+        tolerances = [None] + [float(t) for t in args.simplify.split(',')]
+        results['simplify'] = simplifyReport(sl.dirFiles(args.train), sl.dirFiles(args.test),
+                                             tolerances)
+        reportSimplify(results['simplify'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
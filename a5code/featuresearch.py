@@ -0,0 +1,213 @@
+#Search over feature subsets and bin counts
+#-------------------------------------------------
+# Trains and tests one HMM per candidate feature set, in parallel worker
+# processes, from a FeatureStore (see featurestore.py) so the corpus is
+# parsed and measured only once.  For every candidate it reports the
+# accuracy, the time spent training and labeling, and what its feature
+# kernels cost to compute, so the cheapest feature set that is accurate
+# enough can be picked.
+#
+# usage: python featuresearch.py [--train ../trainForResults] [--test ../testForResults]
+#                                [--features x,bb_area,length] [--bins 2,4] [--size 1-3]
+#                                [--target 0.8] [-w 4] [-o results.json]
+#        python featuresearch.py --train ../trainingFiles -k 5
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import StrokeHmm
+import benchmark
+import featurestore
+
+
+def candidates( featureNames, sizes, binCounts ):
+    ''' Every subset of featureNames with a size in sizes, combined with
+        every assignment of the bin counts in binCounts to its discrete
+        features.  An empty binCounts keeps each feature's default.
+        Returns a list of (feature names, numFVals) pairs. '''
+    ret = []
+    for size in sizes:
+        for names in itertools.combinations(featureNames, size):
+            discrete = [f for f in names if StrokeHmm.FEATURES[f].kind == StrokeHmm.DISCRETE]
+            if not binCounts:
+                ret.append((list(names), {}))
+                continue
+            for bins in itertools.product(binCounts, repeat=len(discrete)):
+                ret.append((list(names), dict(zip(discrete, bins))))
+    return ret
+
+
+def kernelCosts( files, labeler=None ):
+    ''' Milliseconds per 1000 strokes each registered feature kernel takes,
+        measured on the given labeled files '''
+    labeler = labeler or StrokeHmm.StrokeLabeler()
+    total = dict([(name, 0.0) for name in StrokeHmm.FEATURES])
+    numStrokes = 0
+    for f in files:
+        strokes, labels = labeler.loadLabeledFile(f)
+        arrays = StrokeHmm.SketchArrays(strokes)
+        numStrokes += len(strokes)
+        for name in StrokeHmm.FEATURES:
+            start = time.time()
+            StrokeHmm.FEATURES[name].kernel(arrays)
+            total[name] += time.time() - start
+    return dict([(name, 1e6 * total[name] / max(numStrokes, 1)) for name in total])
+
+
+def folds( trainFiles, testFiles=None, k=5 ):
+    ''' The (training files, test files) pairs each candidate is scored on:
+        the given split, or k folds of trainFiles (file i in fold i % k) '''
+    if testFiles:
+        return [(trainFiles, testFiles)]
+    k = min(k, len(trainFiles))
+    return [([f for i, f in enumerate(trainFiles) if i % k != fold],
+             [f for i, f in enumerate(trainFiles) if i % k == fold])
+            for fold in range(k)]
+
+
+# Worker process state, set up once per process by _initSearch
+_store = None
+_folds = None
+_globalBins = False
+
+def _initSearch( storePath, splits, globalBins ):
+    global _store, _folds, _globalBins
+    _store = featurestore.FeatureStore(storePath)
+    _folds = splits
+    _globalBins = globalBins
+
+def evaluate( candidate, store=None, splits=None, globalBins=None ):
+    ''' Train and test one (feature names, numFVals) candidate on every
+        fold.  Returns a dictionary with the features, bins, number of
+        strokes labeled correctly, accuracy, and train and label seconds. '''
+    store = store or _store
+    splits = splits or _folds
+    if globalBins == None:
+        globalBins = _globalBins
+    names, numFVals = candidate
+    sl = StrokeHmm.StrokeLabeler()
+    sl.setFeatures(names, numFVals)
+    right = 0
+    total = 0
+    trainTime = 0.0
+    labelTime = 0.0
+    for trainFiles, testFiles in splits:
+        with benchmark.Quiet():
+            start = time.time()
+            sl.trainHMMStore(store, trainFiles, globalBins)
+            trainTime += time.time() - start
+            start = time.time()
+            for f in testFiles:
+                predicted = sl.labelStore(store, f)
+                truth = store.labels(f)
+                right += sum([1 for t, c in zip(truth, predicted) if t == c])
+                total += len(truth)
+            labelTime += time.time() - start
+    return {'features': names,
+            'bins': dict([(f, sl.numFVals[f]) for f in sl.numFVals]),
+            'right': right,
+            'strokes': total,
+            'accuracy': right / float(max(total, 1)),
+            'trainTime': trainTime,
+            'labelTime': labelTime}
+
+
+def search( store, candidateList, splits, workers=None, globalBins=False, costs=None ):
+    ''' Evaluate every candidate in a pool of worker processes.  With the
+        kernel costs (see kernelCosts) each result also gets the 'cost' of
+        computing its features, in milliseconds per 1000 strokes.  Returns the
+        results, cheapest first. '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _initSearch, (store.path, splits, globalBins))
+    try:
+        results = pool.map(evaluate, candidateList)
+    finally:
+        pool.close()
+        pool.join()
+    for r in results:
+        r['cost'] = sum([costs[f] for f in r['features']]) if costs else None
+    results.sort(key=lambda r: (r['cost'], -r['accuracy']))
+    return results
+
+
+def cheapest( results, target ):
+    ''' The cheapest result with at least the target accuracy, or None '''
+    good = [r for r in results if r['accuracy'] >= target]
+    if not good:
+        return None
+    return min(good, key=lambda r: (r['cost'], -r['accuracy']))
+
+
+def report( results ):
+    print "%8s %8s %8s %8s  %s" % ('accuracy', 'cost ms', 'train s', 'label s', 'features (bins)')
+    for r in results:
+        described = ', '.join([f + ('(%d)' % r['bins'][f] if f in r['bins'] else '')
+                               for f in r['features']])
+        print "%8.3f %8.3f %8.3f %8.3f  %s" % (r['accuracy'], r['cost'] or 0,
+                                              r['trainTime'], r['labelTime'], described)
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Search feature subsets and bin counts')
+    parser.add_argument('--train', default=os.path.join(here, '..', 'trainForResults'),
+                        help='directory of labeled training sketches')
+    parser.add_argument('--test', help='directory of labeled test sketches '
+                                       '(default: k-fold cross validation on --train)')
+    parser.add_argument('-k', type=int, default=5, help='number of folds without --test')
+    parser.add_argument('--features', help='comma separated features to choose from '
+                                           '(default: all registered)')
+    parser.add_argument('--size', default='1-3', help='subset sizes, like 2 or 1-3')
+    parser.add_argument('--bins', help='comma separated bin counts to try for each discrete '
+                                       'feature (default: each feature\'s own)')
+    parser.add_argument('--target', type=float, default=0.0, help='accuracy bar')
+    parser.add_argument('--global-bins', action='store_true',
+                        help='learn bin edges over all training strokes')
+    parser.add_argument('--store', help='FeatureStore directory to (re)use')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    sl = StrokeHmm.StrokeLabeler()
+    trainFiles = sl.dirFiles(args.train)
+    testFiles = sl.dirFiles(args.test) if args.test else []
+    featureNames = args.features.split(',') if args.features else sorted(StrokeHmm.FEATURES)
+    lo, _, hi = args.size.partition('-')
+    sizes = range(int(lo), int(hi or lo) + 1)
+    binCounts = [int(b) for b in args.bins.split(',')] if args.bins else []
+
+    storePath = args.store or os.path.join(tempfile.gettempdir(), 'featuresearch.store')
+    store = featurestore.FeatureStore(storePath)
+    start = time.time()
+    measured = store.build(trainFiles + testFiles, sl, args.workers or multiprocessing.cpu_count())
+    print "Feature store has", len(store.files()), "files,", measured, "measured in", \
+          "%.2f s" % (time.time() - start)
+
+    costs = kernelCosts(trainFiles[:10], sl)
+    candidateList = candidates(featureNames, sizes, binCounts)
+    start = time.time()
+    results = search(store, candidateList, folds(trainFiles, testFiles, args.k),
+                     args.workers, args.global_bins, costs)
+    print "Evaluated", len(results), "candidates in", "%.2f s" % (time.time() - start)
+    report(results)
+
+    best = cheapest(results, args.target)
+    if best == None:
+        print "No candidate reaches accuracy", args.target
+    else:
+        print "Cheapest with accuracy >= %.3f: %s %s (accuracy %.3f)" % \
+              (args.target, best['features'], best['bins'], best['accuracy'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'costs': costs, 'results': results, 'best': best}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
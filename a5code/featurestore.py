@@ -0,0 +1,181 @@
+#Columnar store of raw stroke features
+#-------------------------------------------------
+# Caches the raw (unbinned) measurements of every stroke of a set of labeled
+# sketches on disk, one numpy array per feature, so that trying a different
+# combination of features or bins only means reading a few arrays instead of
+# parsing the XML and measuring all the strokes again.
+#
+# A store is a directory holding
+#     index.json        the files in the store, in order, with their size,
+#                       modification time and number of strokes, and the
+#                       labeler settings the strokes were loaded with
+#     strokeIds.npy     the id of every stroke, all files concatenated
+#     labels.npy        the label of every stroke
+#     <feature>.npy     one raw value per stroke for each registered feature
+#
+# Simplifying or compacting strokes at load time changes their features,
+# so a store only serves labelers with the settings it was built with.
+#
+# usage:
+#     store = FeatureStore('corpus.store')
+#     store.build(sl.dirFiles('../trainingFiles'))
+#     sl.setFeatures(['x', 'bb_area'])
+#     sl.trainHMMStore(store)
+
+import json
+import multiprocessing
+import os
+
+import numpy
+
+import StrokeHmm
+
+
+def measureFile( filename, labeler=None ):
+    ''' Load a labeled file and run every registered feature kernel on it.
+        Returns (stroke ids, labels, {feature name: raw values}) '''
+    labeler = labeler or StrokeHmm._workerLabeler or StrokeHmm.StrokeLabeler()
+    strokes, labels = labeler.loadLabeledFile(filename)
+    arrays = StrokeHmm.SketchArrays(strokes)
+    columns = {}
+    for name in StrokeHmm.FEATURES:
+        columns[name] = StrokeHmm.FEATURES[name].kernel(arrays)
+    return [s.strokeId for s in strokes], labels, columns
+
+
+def prepareSettings( labeler ):
+    ''' The labeler settings that change how strokes are loaded and so
+        what their features are (see StrokeLabeler.prepareStrokes) '''
+    return {'simplifyTolerance': labeler.simplifyTolerance,
+            'compact': labeler.compact}
+
+
+class FeatureStore:
+    ''' Raw stroke features of many sketches, stored column by column '''
+
+    def __init__( self, path ):
+        self.path = path
+        self.index = {'files': []}
+        self.offsets = {}
+        if os.path.exists(os.path.join(path, 'index.json')):
+            with open(os.path.join(path, 'index.json')) as f:
+                self.index = json.load(f)
+        self.buildOffsets()
+
+    def buildOffsets( self ):
+        ''' Work out where each file's strokes start and end in the columns '''
+        self.offsets = {}
+        start = 0
+        for entry in self.index['files']:
+            self.offsets[entry['name']] = (start, start + entry['strokes'])
+            start += entry['strokes']
+
+    def files( self ):
+        ''' The files in the store, in order '''
+        return [entry['name'] for entry in self.index['files']]
+
+    def settings( self ):
+        ''' The prepareSettings of the labeler the store was built with '''
+        return self.index.get('settings')
+
+    def check( self, labeler ):
+        ''' Raise ValueError if the labeler loads strokes differently from
+            the labeler the store was built with '''
+        if self.files() and self.settings() != prepareSettings(labeler):
+            raise ValueError('feature store ' + self.path + ' was built with ' +
+                             str(self.settings()) + ', not ' + str(prepareSettings(labeler)))
+
+    def columns( self ):
+        ''' The names of the stored feature columns '''
+        return self.index.get('columns', [])
+
+    def column( self, name ):
+        ''' The whole column for a feature (memory mapped, so reading a
+            few rows does not read the whole array) '''
+        return numpy.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def rawFeatures( self, filename, names ):
+        ''' The raw values of the named features for one file's strokes, as a
+            dictionary like StrokeLabeler.rawFeatures returns '''
+        start, end = self.offsets[filename]
+        return dict([(name, numpy.array(self.column(name)[start:end])) for name in names])
+
+    def labels( self, filename ):
+        start, end = self.offsets[filename]
+        return [str(l) for l in self.column('labels')[start:end]]
+
+    def strokeIds( self, filename ):
+        start, end = self.offsets[filename]
+        return [str(s) for s in self.column('strokeIds')[start:end]]
+
+    def isCurrent( self, entry ):
+        ''' Has the file behind an index entry not changed since it was stored? '''
+        try:
+            st = os.stat(entry['name'])
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime == entry['mtime']
+
+    def build( self, files, labeler=None, workers=1 ):
+        ''' Make the store hold exactly the given labeled files.  Files that
+            are already stored and unchanged are kept; the rest are measured,
+            in parallel when workers > 1.  If the labeler's prepareSettings
+            differ from the store's, every file is measured again.  Returns
+            the number of files measured. '''
+        labeler = labeler or StrokeHmm.StrokeLabeler()
+        files = list(files)
+        if len(set(files)) != len(files):
+            twice = sorted(set([f for f in files if files.count(f) > 1]))
+            raise ValueError('files listed more than once: ' + ', '.join(twice))
+        names = sorted(StrokeHmm.FEATURES.keys())
+        settings = prepareSettings(labeler)
+        old = {}
+        if set(self.columns()) == set(names) and self.settings() == settings:
+            for entry in self.index['files']:
+                if self.isCurrent(entry):
+                    old[entry['name']] = entry
+        toMeasure = [f for f in files if f not in old]
+        if not toMeasure and files == self.files():
+            return 0
+
+        if workers > 1 and toMeasure:
+            pool = multiprocessing.Pool(workers, StrokeHmm._initWorker, (labeler,))
+            try:
+                measured = pool.map(measureFile, toMeasure)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            measured = [measureFile(f, labeler) for f in toMeasure]
+        measured = dict(zip(toMeasure, measured))
+
+        # read the kept files' rows before the columns are rewritten
+        pieces = {}
+        for f in files:
+            if f in measured:
+                pieces[f] = measured[f]
+            else:
+                columns = self.rawFeatures(f, names)
+                pieces[f] = (self.strokeIds(f), self.labels(f), columns)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        entries = []
+        for f in files:
+            st = os.stat(f)
+            entries.append({'name': f, 'size': st.st_size, 'mtime': st.st_mtime,
+                            'strokes': len(pieces[f][0])})
+        numpy.save(os.path.join(self.path, 'strokeIds.npy'),
+                   numpy.array([sid for f in files for sid in pieces[f][0]], dtype=str))
+        numpy.save(os.path.join(self.path, 'labels.npy'),
+                   numpy.array([l for f in files for l in pieces[f][1]], dtype=str))
+        for name in names:
+            values = [pieces[f][2][name] for f in files]
+            column = numpy.concatenate(values) if values else numpy.zeros(0)
+            numpy.save(os.path.join(self.path, name + '.npy'), column)
+
+        self.index = {'files': entries, 'columns': names, 'settings': settings}
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump(self.index, f, indent=1)
+        self.buildOffsets()
+        return len(toMeasure)
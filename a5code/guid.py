@@ -72,8 +72,19 @@
 #                    for IP when we make it up (when it's no accessible)
 # November 21, 2005  Added better IP-finding code.  It finds IP address better now.
 # January 5, 2006    Fixed a small bug caused in old versions of python (random module use)
+# October 19, 2026   Added generate_batch to reserve many counters under one lock acquisition
+# October 19, 2026   The IP address is looked up on the first generate() instead of at import,
+#                    can be set with set_ip() or the GUID_IP environment variable, and falls
+#                    back to a made up address if the lookup takes longer than RESOLVE_TIMEOUT
+# October 19, 2026   Added the Generator class and thread_generator(): generators with their
+#                    own state and no lock, one per thread, that put a process id and
+#                    generator number in the guid where generate() puts the counter and ip
+# October 19, 2026   Generator keeps the whole process id (6 hex digits) instead of its low
+#                    16 bits, which repeat on hosts with pid_max above 65536; the counter
+#                    and generator number get 3 digits each to make room
 
 import math
+import os
 import socket
 import random
 import sys
@@ -89,25 +100,75 @@ import threading
 make_hexip = lambda ip: ''.join(["%04x" % long(i) for i in ip.split('.')]) # leave space for ip v6 (65K in each sub)
   
 MAX_COUNTER = 0xfffffffe
+RESOLVE_TIMEOUT = 0.5  # seconds to wait for the host name lookup before making up an ip
 counter = 0L
 firstcounter = MAX_COUNTER
 lasttime = 0
 ip = ''
+hexip = None  # looked up on the first generate(), see get_hexip()
 lock = threading.RLock()
-try:  # only need to get the IP addresss once
-  ip = socket.getaddrinfo(socket.gethostname(),0)[-1][-1][0]
-  hexip = make_hexip(ip)
-except: # if we don't have an ip, default to someting in the 10.x.x.x private range
+
+
+def make_random_ip():
+  '''Makes up an ip in the 10.x.x.x private range'''
   ip = '10'
   rand = random.Random()
   for i in range(3):
     ip += '.' + str(rand.randrange(1, 0xffff))  # might as well use IPv6 range if we're making it up
-  hexip = make_hexip(ip)
+  return ip
+
+
+def resolve_ip():
+  '''Looks up the ip of this host, in a background thread so that a slow name
+     server can hold us up for at most RESOLVE_TIMEOUT seconds.  Returns None
+     if the lookup fails or takes too long.'''
+  found = []
+  def lookup():
+    try:
+      found.append(socket.getaddrinfo(socket.gethostname(),0)[-1][-1][0])
+    except:
+      pass
+  thread = threading.Thread(target=lookup)
+  thread.daemon = True
+  thread.start()
+  thread.join(RESOLVE_TIMEOUT)
+  if found:
+    return found[0]
+  return None
 
   
 #################################
 ###   Public module functions
 
+def set_ip(newip):
+  '''Sets the ip used in the guids, skipping the host name lookup'''
+  global ip, hexip
+  lock.acquire()
+  try:
+    ip = newip
+    hexip = make_hexip(newip)
+  finally:
+    lock.release()
+
+
+def get_hexip():
+  '''Returns the hex ip used in the guids.  The first call works it out: from
+     the GUID_IP environment variable if set, otherwise by looking up the host
+     name, otherwise by making one up.'''
+  if hexip is None:
+    lock.acquire()
+    try:
+      if hexip is None:
+        newip = os.environ.get('GUID_IP') or resolve_ip()
+        try:
+          set_ip(newip)
+        except: # no ip, or not a dotted ipv4 address
+          set_ip(make_random_ip())
+    finally:
+      lock.release()
+  return hexip
+
+
 def generate(ip=None):
   '''Generates a new guid.  A guid is unique in space and time because it combines
      the machine IP with the current time in milliseconds.  Be careful about sending in
@@ -139,7 +200,7 @@ def generate(ip=None):
     parts.append("%08x" % (counter)) 
 
     # ip part
-    parts.append(hexip)
+    parts.append(get_hexip())
 
     partsStr = ''.join(parts)
     partsStr = partsStr[0:8] + '-' + partsStr[8:12] + '-' + partsStr[12:16] + \
@@ -148,8 +209,146 @@ def generate(ip=None):
     return partsStr
   finally:
     lock.release()
+
+
+def generate_batch(n):
+  '''Generates a list of n new guids, the same as n calls to generate() would
+     give, but the lock is taken once for the whole batch: a block of counters
+     is reserved for the current millisecond and the guids are formatted after
+     the lock is released.
+  '''
+  global counter, firstcounter, lasttime
+  blocks = []  # (time, first counter, number of counters) reserved
+  reserved = 0
+  lock.acquire()
+  try:
+    while reserved < n:
+      # do we need to wait for the next millisecond (are we out of counters?)
+      now = long(time.time() * 1000)
+      while lasttime == now and counter == firstcounter:
+        time.sleep(.01)
+        now = long(time.time() * 1000)
+
+      if lasttime != now:  # a new millisecond, so all the counters are free
+        firstcounter = long(random.uniform(1, MAX_COUNTER))  # start at random position
+        counter = firstcounter
+        left = MAX_COUNTER + 1
+      else:  # the counters between here and firstcounter are still free
+        left = (firstcounter - counter) % (MAX_COUNTER + 1)
+      take = min(n - reserved, left)
+      blocks.append((now, counter, take))
+      counter = (counter + take) % (MAX_COUNTER + 1)
+      lasttime = now
+      reserved += take
+  finally:
+    lock.release()
+
+  ret = []
+  for now, start, take in blocks:
+    timePart = "%016x" % now
+    head = timePart[0:8] + '-' + timePart[8:12] + '-' + timePart[12:16] + '-'
+    tail = get_hexip()[0:8]
+    for i in xrange(1, take + 1):
+      counterPart = "%08x" % ((start + i) % (MAX_COUNTER + 1))
+      ret.append(head + counterPart[0:4] + '-' + counterPart[4:8] + tail)
+  return ret
     
 
+class Generator:
+  '''A guid generator with its own time and counter state, so it never waits on
+     the module lock.  Use one per thread (see thread_generator); a single
+     Generator must not be shared between threads.
+
+     Its guids sort by time like the ones from generate(), but the last 16 hex
+     digits hold a 3 digit counter, 4 digits folded from the ip, the whole
+     process id in 6 digits (Linux pids stay below 2**22) and 3 numbering the
+     generators made in this process:
+
+         tttttttt-tttt-tttt-ccci-iiippppppnnn
+
+     so generators in different threads and processes on one host never make
+     the same guid in the same millisecond, unless a process makes more than
+     4096 generators and their numbers wrap around.  Hosts are told apart
+     only by the 16 bits folded from their ips.  Up to 4096 guids are made
+     per millisecond; after that it waits for the next millisecond.
+  '''
+  MAX_COUNTER = 0xfff
+
+  def __init__(self):
+    self.pid = None
+    self.start_process()
+
+  def start_process(self):
+    '''(Re)builds the process and generator part, also after a fork'''
+    self.pid = os.getpid()
+    number = next_generator_number()
+    hexip = get_hexip()
+    folded = 0
+    for i in range(0, len(hexip), 4):
+      folded ^= int(hexip[i:i + 4], 16)
+    self.tail = "%04x%06x%03x" % (folded & 0xffff, self.pid & 0xffffff, number & 0xfff)
+    self.counter = 0
+    self.lasttime = 0
+
+  def reserve(self, n):
+    '''Reserves n counters and returns them as a list of (time, counter)'''
+    if os.getpid() != self.pid:
+      self.start_process()
+    ret = []
+    while len(ret) < n:
+      now = long(time.time() * 1000)
+      if now != self.lasttime:
+        self.lasttime = now
+        self.counter = 0
+      elif self.counter > self.MAX_COUNTER:  # out of counters, wait for the next millisecond
+        time.sleep(.001)
+        continue
+      take = min(n - len(ret), self.MAX_COUNTER + 1 - self.counter)
+      ret.extend([(now, c) for c in xrange(self.counter, self.counter + take)])
+      self.counter += take
+    return ret
+
+  def generate(self):
+    '''Generates a new guid'''
+    return self.generate_batch(1)[0]
+
+  def generate_batch(self, n):
+    '''Generates a list of n new guids'''
+    ret = []
+    lastnow = None
+    for now, c in self.reserve(n):
+      if now != lastnow:
+        timePart = "%016x" % now
+        head = timePart[0:8] + '-' + timePart[8:12] + '-' + timePart[12:16] + '-'
+        lastnow = now
+      ret.append("%s%03x%s-%s" % (head, c, self.tail[0], self.tail[1:]))
+    return ret
+
+
+generator_numbers = [0]
+
+def next_generator_number():
+  '''Numbers the Generators made in this process'''
+  lock.acquire()
+  try:
+    generator_numbers[0] += 1
+    return generator_numbers[0]
+  finally:
+    lock.release()
+
+
+local = threading.local()
+
+def thread_generator():
+  '''Returns the Generator belonging to the calling thread, making it on
+     the thread's first call'''
+  try:
+    return local.generator
+  except AttributeError:
+    local.generator = Generator()
+    return local.generator
+
+
 """  These functions no longer work since I added dashes into the guid
 def extract_time(guid):
   '''Extracts the time portion out of the guid and returns the 
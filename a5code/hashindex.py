@@ -0,0 +1,96 @@
+#Content hashes of sketch files
+#-------------------------------------------------
+# The same sketch is often copied into several directories under the same
+# or another name.  StrokeLabeler fingerprints files by the SHA-1 of their
+# contents to skip duplicates when training and to spot test files that
+# were also trained on.
+#
+# Hashing a whole corpus on every run would cost nearly as much as parsing
+# it, so each directory gets a small cache file, .strokehashes.json,
+# mapping file names to their size, modification time and hash.  A file
+# is only hashed again when its size or time changes.  The name starts
+# with a dot so StrokeLabeler.dirFiles never treats it as a sketch.  To
+# leave the corpus directories alone, give HashIndex a cacheDir and the
+# caches are kept there instead, one per corpus directory.  StrokeLabeler
+# keeps its caches in ~/.strokehashes.
+#
+# usage:
+#     index = HashIndex()    # or HashIndex(os.path.expanduser('~/.strokehashes'))
+#     index.fingerprint('../trainingFiles/0128_1.6.1.labeled.xml')
+#     index.save()
+
+import errno
+import hashlib
+import json
+import os
+
+CACHE_NAME = '.strokehashes.json'
+
+
+def fileHash( filename, blockSize=1<<20 ):
+    ''' The SHA-1 hex digest of a file's contents '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(blockSize)
+        while block:
+            h.update(block)
+            block = f.read(blockSize)
+    return h.hexdigest()
+
+
+class HashIndex:
+    ''' Content hashes of files, cached per directory '''
+
+    def __init__( self, cacheDir=None ):
+        self.cacheDir = cacheDir
+        self.caches = {}    # directory -> {file name: [size, mtime, hash]}
+        self.dirty = set()
+
+    def cachePath( self, directory ):
+        ''' Where the cache of a directory's hashes is kept '''
+        if self.cacheDir is None:
+            return os.path.join(directory, CACHE_NAME)
+        return os.path.join(self.cacheDir, hashlib.sha1(directory).hexdigest() + '.json')
+
+    def cache( self, directory ):
+        if directory not in self.caches:
+            self.caches[directory] = {}
+            path = self.cachePath(directory)
+            if os.path.exists(path):
+                try:
+                    with open(path) as f:
+                        self.caches[directory] = json.load(f)
+                except ValueError:
+                    pass    # a damaged cache is just rebuilt
+        return self.caches[directory]
+
+    def fingerprint( self, filename ):
+        ''' The content hash of filename, from the cache when the file has
+            not changed since it was hashed '''
+        directory, name = os.path.split(os.path.abspath(filename))
+        cache = self.cache(directory)
+        st = os.stat(filename)
+        entry = cache.get(name)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            entry = [st.st_size, st.st_mtime, fileHash(filename)]
+            cache[name] = entry
+            self.dirty.add(directory)
+        return entry[2]
+
+    def save( self ):
+        ''' Write the caches of directories with new hashes.  Caches that
+            cannot be written are skipped; their files are hashed again
+            next time. '''
+        if self.cacheDir is not None:
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    return
+        for directory in self.dirty:
+            try:
+                with open(self.cachePath(directory), 'w') as f:
+                    json.dump(self.caches[directory], f)
+            except IOError:
+                pass
+        self.dirty = set()
@@ -0,0 +1,119 @@
+#Stage timers and counters
+#-------------------------------------------------
+# Lightweight instrumentation for StrokeHmm.  Code marks its stages with
+#
+#     with instrument.timer('featurefy'):
+#         ...
+#     instrument.count('points', len(points))
+#
+# Nothing is recorded until enable() is called; while disabled timer()
+# hands back one shared do-nothing context manager, so the cost is a
+# global lookup and a function call.
+#
+# usage:
+#     instrument.enable()               # or enable(callback)
+#     sl.labelFile('in.xml', 'out.xml')
+#     instrument.report()
+
+import sys
+import time
+
+import numpy
+
+enabled = False
+callback = None     # called as callback(name, seconds) after every timed stage
+samples = {}        # stage name -> list of durations in seconds
+counters = {}       # counter name -> total
+
+
+class NullTimer:
+    ''' The timer handed out while instrumentation is disabled '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    ''' Records how long the with block took under its stage name '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.time() - self.start
+        samples.setdefault(self.name, []).append(seconds)
+        if callback is not None:
+            callback(self.name, seconds)
+        return False
+
+
+def enable(newCallback=None):
+    ''' Start recording, optionally passing every timing to newCallback '''
+    global enabled, callback
+    enabled = True
+    callback = newCallback
+
+
+def disable():
+    ''' Stop recording (what has been recorded so far is kept) '''
+    global enabled, callback
+    enabled = False
+    callback = None
+
+
+def reset():
+    ''' Throw away everything recorded so far '''
+    samples.clear()
+    counters.clear()
+
+
+def timer(name):
+    ''' A context manager timing the stage called name '''
+    if not enabled:
+        return NULL_TIMER
+    return Timer(name)
+
+
+def count(name, n=1):
+    ''' Add n to the counter called name '''
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+def stats():
+    ''' Summarize the recorded timings: a dictionary mapping each stage name
+        to its call count, total, mean, 50th/90th/99th percentile and max
+        (in seconds), plus the counters under the key 'counters' '''
+    ret = {}
+    for name, values in samples.items():
+        p50, p90, p99 = [float(p) for p in numpy.percentile(values, [50, 90, 99])]
+        ret[name] = {'calls': len(values),
+                     'total': sum(values),
+                     'mean': sum(values) / len(values),
+                     'p50': p50,
+                     'p90': p90,
+                     'p99': p99,
+                     'max': max(values)}
+    return {'stages': ret, 'counters': dict(counters)}
+
+
+def report(out=None):
+    ''' Print a table of the recorded timings and counters '''
+    out = out or sys.stdout
+    summary = stats()
+    out.write("%-28s %8s %10s %10s %10s %10s %10s\n" %
+              ('stage', 'calls', 'total', 'mean', 'p50', 'p90', 'p99'))
+    stages = summary['stages']
+    for name in sorted(stages, key=lambda n: -stages[n]['total']):
+        s = stages[name]
+        out.write("%-28s %8d %10.4f %10.6f %10.6f %10.6f %10.6f\n" %
+                  (name, s['calls'], s['total'], s['mean'], s['p50'], s['p90'], s['p99']))
+    for name in sorted(summary['counters']):
+        out.write("%-28s %8d\n" % (name, summary['counters'][name]))
@@ -0,0 +1,174 @@
+#Compiled kernels
+#-------------------------------------------------
+# Loop versions of the hot spots of StrokeHmm: first order Viterbi, the
+# nearest neighbor and curvature feature kernels and
+# Stroke.sumOfCurvature.  When numba is installed StrokeHmm calls them,
+# compiled to machine code, instead of its own NumPy (or plain Python)
+# code.  Without numba nothing changes.  njit compiles each kernel on its
+# first call, not at import, and cache=True keeps the machine code on disk
+# so later processes skip most of that cost.
+#
+# Each loop does the same floating point operations in the same order as
+# the code it replaces, so both backends give bit-identical results
+# (benchmark.py --kernels checks this and times both).
+#
+# The backend is picked at import: 'numba' if numba can be imported,
+# unless the environment variable STROKEHMM_BACKEND is 'numpy'.
+# use() switches it at run time.
+
+import math
+import os
+
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def viterbiLoop( logPriors, logTransitions, evidence ):
+    ''' LogModel.viterbi as loops.  Returns (log probability, path array) '''
+    T, S = evidence.shape
+    back = numpy.zeros((T, S), dtype=numpy.int64)
+    delta = logPriors + evidence[0]
+    new = numpy.empty(S)
+    for t in range(1, T):
+        for j in range(S):
+            best = delta[0] + logTransitions[0, j]
+            arg = 0
+            for i in range(1, S):
+                cand = delta[i] + logTransitions[i, j]
+                if cand > best:
+                    best = cand
+                    arg = i
+            back[t, j] = arg
+            new[j] = best + evidence[t, j]
+        for j in range(S):
+            delta[j] = new[j]
+
+    last = 0
+    for j in range(1, S):
+        if delta[j] > delta[last]:
+            last = j
+    score = delta[last]
+    path = numpy.empty(T, dtype=numpy.int64)
+    path[T-1] = last
+    for t in range(T-1, 0, -1):
+        last = back[t, last]
+        path[t-1] = last
+    return score, path
+
+
+def nearestNeighborLoop( xs, ys, starts ):
+    ''' nearestNeighborKernel as loops: the distance from the first point
+        of each stroke to the closest point of another stroke, not counting
+        the other strokes' first points '''
+    N = len(starts) - 1
+    ret = numpy.empty(N)
+    for i in range(N):
+        sx = xs[starts[i]]
+        sy = ys[starts[i]]
+        best = 1000000.0
+        for k in range(N):
+            if k == i:
+                continue
+            for p in range(starts[k] + 1, starts[k+1]):
+                d = math.sqrt((sx - xs[p])**2 + (sy - ys[p])**2)
+                if d < best:
+                    best = d
+        ret[i] = best
+    return ret
+
+
+def curvatureLoop( xs, ys, starts ):
+    ''' curvatureKernel as loops: the summed absolute curvature of each
+        stroke divided by its number of points '''
+    N = len(starts) - 1
+    ret = numpy.empty(N)
+    for i in range(N):
+        total = 0.0
+        for p in range(starts[i], starts[i+1] - 2):
+            ax = xs[p+1] - xs[p]
+            ay = ys[p+1] - ys[p]
+            bx = xs[p+2] - xs[p+1]
+            by = ys[p+2] - ys[p+1]
+            denom = math.sqrt(ax**2 + ay**2) * math.sqrt(bx**2 + by**2)
+            if denom == 0:
+                continue    # the NumPy kernel's nan, counted as 0
+            arg = (ax*bx + ay*by) / denom
+            arg = min(max(arg, -1.0), 1.0)
+            total += math.acos(arg)
+        ret[i] = total / (starts[i+1] - starts[i])
+    return ret
+
+
+def sumOfCurvatureLoop( xs, ys, skip, absolute ):
+    ''' Stroke.sumOfCurvature for func abs (absolute True) or the identity '''
+    n = len(xs)
+    if n < 2*skip + 1:
+        return 0.0
+    ret = 0.0
+    x2 = xs[0]
+    y2 = ys[0]
+    x3 = xs[skip]
+    y3 = ys[skip]
+    for p in range(2*skip, n, skip):
+        x1 = x2
+        y1 = y2
+        x2 = x3
+        y2 = y3
+        x3 = xs[p]
+        y3 = ys[p]
+        ax = x2 - x1
+        ay = y2 - y1
+        bx = x3 - x2
+        by = y3 - y2
+        lena = math.sqrt(ax**2 + ay**2)
+        lenb = math.sqrt(bx**2 + by**2)
+        arg = (ax*bx + ay*by) / (lena*lenb)
+        if arg > 1.0:
+            arg = 1.0
+        if arg < -1.0:
+            arg = -1.0
+        curv = math.acos(arg)
+        anga = math.atan2(ay, ax)
+        angb = math.atan2(by, bx)
+        if not (angb < anga and angb > anga - math.pi):
+            curv *= -1
+        if absolute:
+            curv = abs(curv)
+        ret += curv
+    return ret / n
+
+
+LOOPS = {'viterbi': viterbiLoop,
+         'nearestNeighbor': nearestNeighborLoop,
+         'curvature': curvatureLoop,
+         'sumOfCurvature': sumOfCurvatureLoop}
+
+COMPILED = {}
+if numba is not None:
+    for name in LOOPS:
+        COMPILED[name] = numba.njit(cache=True)(LOOPS[name])
+
+backend = 'numpy'
+if COMPILED and os.environ.get('STROKEHMM_BACKEND', 'numba') != 'numpy':
+    backend = 'numba'
+
+
+def use( name ):
+    ''' Switch to the 'numba' or 'numpy' backend '''
+    global backend
+    if name == 'numba' and not COMPILED:
+        raise ValueError('numba is not installed')
+    if name not in ('numba', 'numpy'):
+        raise ValueError('unknown backend ' + name)
+    backend = name
+
+
+def get( name ):
+    ''' The compiled kernel to call, or None to use the NumPy code '''
+    if backend == 'numba':
+        return COMPILED[name]
+    return None
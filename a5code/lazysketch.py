@@ -0,0 +1,246 @@
+#Lazy stroke loading
+#-------------------------------------------------
+# StrokeLabeler.loadStrokeFile builds a DOM of the whole sketch and turns
+# every point into a Python tuple before anything else happens.  Here the
+# file is scanned once with expat, keeping only the byte offset of each
+# point element and, for each stroke, the ranges of points that make it
+# up.  A stroke's coordinates are decoded from the file the first time its
+# points are used (by a feature, or saveFile), and with maxResidentPoints
+# the least recently decoded strokes are dropped again so no more than
+# that many points are held at once.  With simplifyTolerance, each stroke
+# is simplified as it is decoded, like StrokeLabeler.simplifyStrokes does
+# at load time; Douglas-Peucker keeps the first and last points, so the
+# stroke times do not change.
+#
+# LazyStroke is a Stroke, so the strokes can go anywhere strokes from
+# loadStrokeFile go.
+#
+# usage:
+#     sketch = LazySketch('big.xml', maxResidentPoints=100000)
+#     labels = sl.labelStrokes(sketch.strokes)
+#     sl.saveFile(sketch.strokes, labels, 'big.xml', 'big.labeled.xml')
+#     sketch.close()
+
+import collections
+import mmap
+import re
+import xml.parsers.expat
+
+import numpy
+
+import StrokeHmm
+import instrument
+
+POINT_TAG = re.compile(r'<point\b[^>]*>')
+ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def pointRuns( ordinals ):
+    ''' Compress a list of point numbers into (start, end) ranges of
+        consecutive numbers '''
+    runs = []
+    for n in ordinals:
+        if runs and runs[-1][1] == n:
+            runs[-1][1] = n + 1
+        else:
+            runs.append([n, n + 1])
+    return [tuple(r) for r in runs]
+
+
+class LazyStroke(StrokeHmm.Stroke):
+    ''' A stroke whose points are decoded from its sketch's file the first
+        time self.points is read '''
+
+    def __init__(self, strokeId, sketch, runs):
+        StrokeHmm.Stroke.__init__(self, strokeId)
+        self.sketch = sketch
+        self.runs = runs    # (start, end) ranges of point numbers in the file
+
+    def __getattr__(self, name):
+        # only called when there is no such attribute, i.e. the points are
+        # not decoded (or were dropped to stay under maxResidentPoints)
+        if name != 'points':
+            raise AttributeError(name)
+        return self.sketch.loadPoints(self)
+
+    def isLoaded( self ):
+        return 'points' in self.__dict__
+
+    def unload( self ):
+        if self.isLoaded():
+            del self.points
+
+    def startTime( self ):
+        ''' The time of the first point, decoding only that point '''
+        if self.isLoaded():
+            return self.points[0][2]
+        return self.sketch.decodePoint(self.runs[0][0])[2]
+
+    def endTime( self ):
+        ''' The time of the last point loadStrokeFile would keep, decoding
+            points from the end only until it is found.  Points that do not
+            move are dropped, so that is the first point of the final run of
+            points at one position. '''
+        if self.isLoaded():
+            return self.points[-1][2]
+        ordinals = [n for start, end in reversed(self.runs) for n in xrange(end - 1, start - 1, -1)]
+        last = self.sketch.decodePoint(ordinals[0])
+        for n in ordinals[1:]:
+            p = self.sketch.decodePoint(n)
+            if p[:2] != last[:2]:
+                break
+            last = p
+        return last[2]
+
+
+class LazySketch:
+    ''' The strokes of a sketch file, with their points left in the file
+        until they are needed.  self.strokes is in file order, like
+        StrokeLabeler.loadStrokeFile returns. '''
+
+    def __init__(self, filename, maxResidentPoints=None, simplifyTolerance=None):
+        self.filename = filename
+        self.maxResidentPoints = maxResidentPoints
+        self.simplifyTolerance = simplifyTolerance
+        self.resident = collections.OrderedDict()   # decoded stroke -> number of points
+        self.residentPoints = 0
+        self.file = None
+        self.data = None
+        with instrument.timer('lazysketch.scan'):
+            self.scan()
+
+    def scan( self ):
+        ''' Read the file once with expat, recording where every point is
+            and which points and substrokes each stroke is made of '''
+        parser = xml.parsers.expat.ParserCreate()
+        offsets = []
+        pointIds = {}
+        shapes = {}
+        strokeIds = []
+        state = {'shape': None, 'arg': None}
+
+        def start(name, attrs):
+            if name == 'point':
+                pointIds[attrs['id']] = len(offsets)
+                offsets.append(parser.CurrentByteIndex)
+            elif name == 'shape':
+                state['shape'] = (attrs.get('type'), attrs.get('id'), [])
+                if attrs.get('type') == 'stroke':
+                    strokeIds.append(attrs.get('id'))
+            elif name == 'arg' and state['shape'] != None:
+                state['arg'] = (attrs.get('type'), [])
+
+        def end(name):
+            if name == 'arg' and state['arg'] != None:
+                argType, text = state['arg']
+                state['shape'][2].append((argType, ''.join(text).strip()))
+                state['arg'] = None
+            elif name == 'shape' and state['shape'] != None:
+                shapeType, shapeId, args = state['shape']
+                shapes[shapeId] = args
+                state['shape'] = None
+
+        def chars(data):
+            if state['arg'] != None:
+                state['arg'][1].append(data)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = chars
+        with open(self.filename, 'rb') as f:
+            parser.ParseFile(f)
+
+        self.offsets = numpy.array(offsets, dtype=numpy.int64)
+        self.strokes = []
+        for strokeId in strokeIds:
+            ordinals = []
+            substrokeIds = []
+            for argType, ssid in shapes[strokeId]:
+                if argType != 'substroke':
+                    continue
+                substrokeIds.append(ssid)
+                ordinals.extend([pointIds[pid] for argType2, pid in shapes[ssid]
+                                 if argType2 == 'point'])
+            stroke = LazyStroke(strokeId, self, pointRuns(ordinals))
+            for ssid in substrokeIds:
+                stroke.addSubstroke(ssid)
+            self.strokes.append(stroke)
+        instrument.count('points.scanned', len(offsets))
+
+    def open( self ):
+        if self.data == None:
+            self.file = open(self.filename, 'rb')
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close( self ):
+        ''' Close the file; points already decoded stay usable '''
+        if self.data != None:
+            self.data.close()
+            self.file.close()
+            self.data = None
+            self.file = None
+
+    def decodeRun( self, start, end ):
+        ''' The (x, y, time) of the points numbered start to end-1 '''
+        self.open()
+        first = self.offsets[start]
+        last = self.data.find('>', self.offsets[end - 1]) + 1
+        ret = []
+        for tag in POINT_TAG.findall(self.data[first:last]):
+            attrs = dict(ATTRIBUTE.findall(tag))
+            ret.append((int(attrs['x']), int(attrs['y']), int(attrs['time'])))
+        return ret
+
+    def decodePoint( self, n ):
+        return self.decodeRun(n, n + 1)[0]
+
+    def loadPoints( self, stroke ):
+        ''' Decode a stroke's points, dropping points that do not move the
+            way StrokeLabeler.buildStroke does, simplify them if the sketch
+            has a simplifyTolerance and keep them on the stroke (within
+            maxResidentPoints) '''
+        with instrument.timer('lazysketch.decode'):
+            points = []
+            last = None
+            for start, end in stroke.runs:
+                for p in self.decodeRun(start, end):
+                    if last == None or last[0] != p[0] or last[1] != p[1]:
+                        points.append(p)
+                        last = p
+        if self.simplifyTolerance != None and points:
+            with instrument.timer('simplify'):
+                xy = numpy.array(points, dtype=float)
+                keep = StrokeHmm.simplifyMask(xy[:, 0], xy[:, 1], numpy.array([0, len(points)]),
+                                              self.simplifyTolerance)
+                points = [p for p, k in zip(points, keep) if k]
+        instrument.count('points', len(points))
+        stroke.points = points
+        self.resident[stroke] = len(points)
+        self.residentPoints += len(points)
+        if self.maxResidentPoints != None:
+            # drop the least recently decoded strokes, never the one just loaded
+            while self.residentPoints > self.maxResidentPoints and len(self.resident) > 1:
+                old, n = self.resident.popitem(last=False)
+                old.unload()
+                self.residentPoints -= n
+        return points
+
+
+def loadStrokeFile( filename, maxResidentPoints=None, simplifyTolerance=None ):
+    ''' A lazy counterpart of StrokeLabeler.loadStrokeFile: the strokes of
+        the file, with points decoded (and simplified) on first use '''
+    return LazySketch(filename, maxResidentPoints, simplifyTolerance).strokes
+
+
+def labelFile( labeler, strokeFile, outFile, maxResidentPoints=None ):
+    ''' StrokeLabeler.labelFile with lazily loaded strokes, simplified
+        with the labeler's simplifyTolerance '''
+    sketch = LazySketch(strokeFile, maxResidentPoints, labeler.simplifyTolerance)
+    try:
+        labels = labeler.labelStrokes(sketch.strokes)
+        labeler.saveFile(sketch.strokes, labels, strokeFile, outFile)
+    finally:
+        sketch.close()
+    instrument.count('files')
+    instrument.count('strokes', len(sketch.strokes))
+    return labels
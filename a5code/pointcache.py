@@ -0,0 +1,202 @@
+#Compressed point cache for sketches
+#-------------------------------------------------
+# Parsing the XML is the slowest part of loading a sketch, and the XML is
+# mostly point elements with a 36 character id, x, y, pressure and a 13
+# digit time each.  This cache keeps, for every sketch loaded through it,
+# only what StrokeLabeler needs: the stroke and substroke ids, the labels
+# (for labeled files) and the points, delta encoded.
+#
+# Within a stroke consecutive points are close in space and time, so each
+# of x, y and time is stored as the stroke's first value (in the header)
+# and the differences between consecutive points, in the smallest integer
+# dtype that holds them (usually int8 or int16), optionally zlib
+# compressed.  Decoding is a cumulative sum over all the points of the
+# sketch at once.
+#
+# A cache is a directory with one file per sketch:
+#     MAGIC                      8 bytes
+#     header length              little endian uint64
+#     header                     JSON: source file size and mtime, stroke
+#                                and substroke ids, labels, point counts,
+#                                first points and channel dtypes
+#     payload                    the x, y and time deltas one channel
+#                                after the other, zlib compressed if the
+#                                header says so
+# Entries are rebuilt when the source file's size or mtime changes.
+#
+# usage:
+#     cache = PointCache('corpus.points', sl)
+#     strokes, labels = cache.loadLabeledFile('../trainingFiles/0128_1.6.1.labeled.xml')
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+import numpy
+
+import StrokeHmm
+import instrument
+
+MAGIC = 'STRKPTS1'
+DTYPES = [numpy.int8, numpy.int16, numpy.int32, numpy.int64]
+
+
+def smallestDtype( values ):
+    ''' The smallest integer dtype that holds all the values '''
+    if len(values) == 0:
+        return numpy.int8
+    lo, hi = values.min(), values.max()
+    for dtype in DTYPES:
+        info = numpy.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return numpy.int64
+
+
+def encodePoints( strokes, compress=True ):
+    ''' Delta encode the points of the strokes.  Returns (header fields,
+        payload bytes) '''
+    perStroke = [numpy.array(s.points, dtype=numpy.int64).reshape(-1, 3) for s in strokes]
+    for p, s in zip(perStroke, strokes):
+        p[:, 2] += s.timeBase
+    counts = [len(p) for p in perStroke]
+    points = numpy.concatenate(perStroke) if perStroke else numpy.zeros((0, 3), dtype=numpy.int64)
+    starts = numpy.cumsum([0] + counts)[:-1]
+    nonEmpty = numpy.array(counts) > 0
+
+    deltas = numpy.zeros(points.shape, dtype=numpy.int64)
+    deltas[1:] = numpy.diff(points, axis=0)
+    deltas[starts[nonEmpty]] = 0    # every stroke starts from its first point
+    firsts = points[starts[nonEmpty]]
+
+    dtypes = []
+    channels = []
+    for c in range(3):
+        dtype = smallestDtype(deltas[:, c])
+        dtypes.append(numpy.dtype(dtype).name)
+        channels.append(deltas[:, c].astype(numpy.dtype(dtype).newbyteorder('<')).tobytes())
+    payload = ''.join(channels)
+    if compress:
+        payload = zlib.compress(payload)
+    fields = {'counts': counts,
+              'firsts': firsts.tolist(),
+              'dtypes': dtypes,
+              'compressed': compress}
+    return fields, payload
+
+
+def decodePoints( fields, payload ):
+    ''' Decode points written by encodePoints.  Returns (the points of all
+        the strokes as one P x 3 int64 array, stroke start positions) '''
+    if fields['compressed']:
+        payload = zlib.decompress(payload)
+    counts = numpy.array(fields['counts'], dtype=numpy.int64)
+    P = int(counts.sum())
+    starts = numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64)
+    points = numpy.empty((P, 3), dtype=numpy.int64)
+    offset = 0
+    nonEmpty = counts > 0
+    firsts = numpy.array(fields['firsts'], dtype=numpy.int64).reshape(-1, 3)
+    for c in range(3):
+        dtype = numpy.dtype(fields['dtypes'][c]).newbyteorder('<')
+        deltas = numpy.frombuffer(payload, dtype=dtype, count=P, offset=offset)
+        offset += P * dtype.itemsize
+        sums = numpy.cumsum(deltas, dtype=numpy.int64)
+        # shift each stroke's running sum so that it starts at its first value
+        shift = firsts[:, c] - sums[starts[:-1][nonEmpty]]
+        points[:, c] = sums + numpy.repeat(shift, counts[nonEmpty])
+    return points, starts
+
+
+class PointCache:
+    ''' Strokes of sketch files, cached in a directory in compressed form.
+        loadStrokeFile and loadLabeledFile work like the StrokeLabeler
+        methods of the same name, parsing with the labeler on a miss. '''
+
+    def __init__( self, path, labeler=None, compress=True ):
+        self.path = path
+        self.labeler = labeler or StrokeHmm.StrokeLabeler()
+        self.compress = compress
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entryPath( self, filename, labeled ):
+        key = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return os.path.join(self.path, key + ('.labeled' if labeled else '') + '.pts')
+
+    def read( self, filename, labeled ):
+        ''' The cached (header, payload) for a file, or None if there is no
+            up to date entry '''
+        path = self.entryPath(filename, labeled)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            return None
+        (length,) = struct.unpack('<Q', data[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8 + length
+        header = json.loads(data[len(MAGIC) + 8:start])
+        st = os.stat(filename)
+        if header['size'] != st.st_size or header['mtime'] != st.st_mtime:
+            return None
+        return header, data[start:]
+
+    def write( self, filename, labeled, strokes, labels ):
+        st = os.stat(filename)
+        header, payload = encodePoints(strokes, self.compress)
+        header.update({'size': st.st_size,
+                       'mtime': st.st_mtime,
+                       'strokeIds': [s.strokeId for s in strokes],
+                       'substrokeIds': [s.substrokeIds for s in strokes],
+                       'labels': labels})
+        text = json.dumps(header)
+        with open(self.entryPath(filename, labeled), 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(text)))
+            f.write(text)
+            f.write(payload)
+
+    def strokes( self, header, payload ):
+        ''' Build Stroke objects from a cache entry.  Each stroke's points
+            are a view of one decoded array. '''
+        points, starts = decodePoints(header, payload)
+        ret = []
+        for i, strokeId in enumerate(header['strokeIds']):
+            stroke = StrokeHmm.Stroke(str(strokeId))
+            for ssid in header['substrokeIds'][i]:
+                stroke.addSubstroke(str(ssid))
+            stroke.setPoints(points[starts[i]:starts[i+1]])
+            ret.append(stroke)
+        self.labeler.prepareStrokes(ret)
+        return ret
+
+    def load( self, filename, labeled ):
+        entry = self.read(filename, labeled)
+        if entry is None:
+            instrument.count('pointcache.misses')
+            # cache the points as loaded, simplify and compact afterwards
+            if labeled:
+                strokes, labels = self.labeler.loadLabeledFile(filename, False)
+            else:
+                strokes, labels = self.labeler.loadStrokeFile(filename, False), None
+            self.write(filename, labeled, strokes, labels)
+            self.labeler.prepareStrokes(strokes)
+            return strokes, labels
+        instrument.count('pointcache.hits')
+        with instrument.timer('pointcache.decode'):
+            header, payload = entry
+            labels = header['labels']
+            if labels is not None:
+                labels = [str(l) for l in labels]
+            return self.strokes(header, payload), labels
+
+    def loadStrokeFile( self, filename ):
+        ''' The strokes of a sketch file '''
+        return self.load(filename, False)[0]
+
+    def loadLabeledFile( self, filename ):
+        ''' The strokes of a labeled sketch file and their labels '''
+        return self.load(filename, True)
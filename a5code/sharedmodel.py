@@ -0,0 +1,205 @@
+#Shared trained model for labeling workers
+#-------------------------------------------------
+# A process pool normally gets its own pickled copy of the StrokeLabeler,
+# nested dicts of priors, transitions and emissions included, in every
+# worker.  Here the trained model is written once to a flat file: a small
+# JSON header (states, features, bin edges) followed by the LogModel
+# arrays of log probabilities.  Workers open the file with mmap and build
+# read-only numpy views straight onto its pages, so nothing is copied or
+# unpickled; every worker shares the same physical memory through the page
+# cache.  Putting the file in /dev/shm keeps it in RAM.
+#
+# File layout:
+#     MAGIC                      8 bytes
+#     header length              little endian uint64
+#     header                     JSON, padded to a multiple of 8 bytes
+#     arrays                     little endian float64, at the offsets
+#                                listed in the header
+#
+# usage:
+#     sharedmodel.save(sl, '/dev/shm/strokes.model')
+#     results = sharedmodel.labelFiles('/dev/shm/strokes.model',
+#                                      [('in.xml', 'out.xml'), ...], workers=16)
+
+import json
+import mmap
+import multiprocessing
+import struct
+
+import numpy
+
+import StrokeHmm
+import instrument
+
+MAGIC = 'STRKHMM1'
+
+
+def save( labeler, filename ):
+    ''' Write the labeler's trained HMM to filename in the shared layout '''
+    hmm = labeler.hmm
+    hmm.featureIndices = labeler.featureIndices
+    model = hmm.logModel()
+    arrays = [('logPriors', model.logPriors), ('logTransitions', model.logTransitions)]
+    if model.logTransitions2 is not None:
+        arrays.append(('logTransitions2', model.logTransitions2))
+    for f in model.featureNames:
+        arrays.append(('table.' + f, model.tables[f]))
+
+    header = {'states': model.states,
+              'featureNames': model.featureNames,
+              'featuresCorD': model.featuresCorD,
+              'numFVals': labeler.numFVals,
+              # json keys must be strings, so store the index maps as pairs
+              'featureIndices': dict([(f, sorted(model.featureIndices[f].items()))
+                                      for f in model.featureIndices]),
+              'binEdges': hmm.binEdges,
+              'simplifyTolerance': labeler.simplifyTolerance,
+              'arrays': {}}
+    offset = 0
+    for name, a in arrays:
+        header['arrays'][name] = [offset, list(a.shape)]
+        offset += a.size * 8
+
+    text = json.dumps(header)
+    text += ' ' * (-(len(MAGIC) + 8 + len(text)) % 8)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(text)))
+        f.write(text)
+        for name, a in arrays:
+            f.write(numpy.ascontiguousarray(a, dtype='<f8').tobytes())
+
+
+class SharedModel(StrokeHmm.LogModel):
+    ''' A LogModel whose arrays are read-only views of a memory mapped model
+        file written by save().  Opening one reads only the header.  close()
+        or the end of a with block unmaps the file. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.data = None
+        try:
+            self.load()
+        except:
+            self.close()
+            raise
+
+    def load( self ):
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(self.filename + ' is not a shared model file')
+        (length,) = struct.unpack('<Q', self.data[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8 + length
+        header = json.loads(self.data[len(MAGIC) + 8:start])
+
+        self.dtype = float
+        self.states = [str(s) for s in header['states']]
+        self.featureNames = [str(f) for f in header['featureNames']]
+        self.featuresCorD = dict([(str(f), v) for f, v in header['featuresCorD'].items()])
+        self.numFVals = dict([(str(f), v) for f, v in header['numFVals'].items()])
+        self.featureIndices = dict([(str(f), dict([(k, v) for k, v in pairs]))
+                                    for f, pairs in header['featureIndices'].items()])
+        self.binEdges = None
+        if header['binEdges'] is not None:
+            self.binEdges = dict([(str(f), e) for f, e in header['binEdges'].items()])
+        self.simplifyTolerance = header.get('simplifyTolerance')
+
+        views = {}
+        for name, (offset, shape) in header['arrays'].items():
+            count = int(numpy.prod(shape))
+            views[str(name)] = numpy.frombuffer(self.data, dtype='<f8', count=count,
+                                                offset=start + offset).reshape(shape)
+        self.logPriors = views['logPriors']
+        self.logTransitions = views['logTransitions']
+        self.logTransitions2 = views.get('logTransitions2')
+        self.tables = dict([(f, views['table.' + f]) for f in self.featureNames])
+
+    def close( self ):
+        ''' Unmap the file.  The arrays are views of the mapping, so they go
+            too and the model cannot label any more. '''
+        self.logPriors = self.logTransitions = self.logTransitions2 = None
+        self.tables = {}
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def labeler( self ):
+        ''' A StrokeLabeler set up with this model's features, for loading
+            and measuring strokes the way the training strokes were.  It
+            holds no copy of the model. '''
+        sl = StrokeHmm.StrokeLabeler()
+        sl.setFeatures(self.featureNames, self.numFVals)
+        sl.simplifyTolerance = self.simplifyTolerance
+        return sl
+
+    def labelStrokes( self, labeler, strokes ):
+        ''' return a list of labels for the given list of strokes, like
+            StrokeLabeler.labelStrokes '''
+        with instrument.timer('featurefy'):
+            raw = labeler.rawFeatures(strokes)
+            edges = self.binEdges
+            if edges is None:
+                edges = labeler.binEdges(raw)
+            features = labeler.binFeatures(raw, edges)
+        with instrument.timer('HMM.label'):
+            score, path = self.decode(self.logEvidence(self.encode(features)))
+        return [self.states[s] for s in path]
+
+
+# Worker process state for labelFiles.  Each worker maps the model file
+# once when it starts.  A Pool replaces workers whose initializer raises,
+# forever, so _attach keeps the error instead and _labelFile raises it,
+# which ends labelFiles.
+_workerModel = None
+_workerLabeler = None
+_workerError = None
+
+def _attach( filename ):
+    global _workerModel, _workerLabeler, _workerError
+    try:
+        _workerModel = SharedModel(filename)
+        _workerLabeler = _workerModel.labeler()
+    except Exception, e:
+        _workerError = e
+
+def _labelFile( args ):
+    ''' Label one file and save the result, returning (strokeFile, number
+        of strokes, error message or None) '''
+    if _workerError is not None:
+        raise _workerError
+    strokeFile, outFile = args
+    try:
+        strokes = _workerLabeler.loadStrokeFile(strokeFile)
+        labels = _workerModel.labelStrokes(_workerLabeler, strokes)
+        _workerLabeler.saveFile(strokes, labels, strokeFile, outFile)
+    except Exception, e:
+        return (strokeFile, 0, str(e))
+    return (strokeFile, len(strokes), None)
+
+
+def labelFiles( modelFile, jobs, workers=None ):
+    ''' Label (strokeFile, outFile) pairs in a pool of workers that all map
+        the same model file.  Returns a (strokeFile, number of strokes,
+        error or None) tuple per job, in order.  Raises IOError or
+        ValueError, before starting any worker, if the model file is
+        missing or damaged. '''
+    with SharedModel(modelFile):
+        pass
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _attach, (modelFile,))
+    try:
+        return pool.map(_labelFile, jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,163 @@
+#Synthetic sketch generator
+#-------------------------------------------------
+# Writes labeled sketch XML in the same format as trainingFiles/*.labeled.xml
+# (points, substrokes, strokes, then Wire and Label shapes) at any size, so
+# the pipeline can be timed on sketches much larger than the bundled ones.
+#
+# usage: python sketchgen.py -n 10000 -o big.labeled.xml
+#        python sketchgen.py --sizes 100,1000,10000 -d synthetic/
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+import guid
+
+START_TIME = 1157434265766   # a millisecond timestamp like the bundled files
+POINT_MS = 8                 # time between pen samples
+
+
+def textStroke(rand, x, y, meanPoints):
+    ''' A short, small stroke, like part of a letter '''
+    n = max(2, int(rand.gauss(meanPoints / 2.0, meanPoints / 6.0)))
+    points = []
+    for i in range(n):
+        points.append((x + int(rand.gauss(i * 6, 3)), y + int(rand.gauss(0, 25))))
+    return points
+
+
+def wireStroke(rand, x, y, meanPoints):
+    ''' A long, mostly straight stroke, like a wire '''
+    n = max(2, int(rand.gauss(meanPoints * 1.5, meanPoints / 3.0)))
+    angle = rand.choice([(1, 0), (0, 1), (1, 1)])
+    step = rand.randint(20, 60)
+    points = []
+    for i in range(n):
+        points.append((x + angle[0] * i * step + rand.randint(-3, 3),
+                       y + angle[1] * i * step + rand.randint(-3, 3)))
+    return points
+
+
+def generateSketch(filename, numStrokes, meanPoints=20, textFraction=0.4, seed=None):
+    ''' Write a labeled sketch with numStrokes strokes to filename.
+        Strokes come in runs of text (Label shapes) and wires (Wire shapes),
+        with about textFraction of the runs being text.  meanPoints sets the
+        typical number of pen samples per stroke.  Returns the number of
+        points written. '''
+    rand = random.Random(seed)
+    tmpDir = tempfile.mkdtemp()
+    # the points come first in the file, so the substrokes, strokes and
+    # shapes are written to their own files and appended at the end
+    sections = [open(os.path.join(tmpDir, name), 'w')
+                for name in ['substrokes', 'strokes', 'shapes']]
+    substrokeOut, strokeOut, shapeOut = sections
+    numPoints = 0
+    try:
+        out = open(filename, 'w')
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        out.write('<sketch id="%s" units="himetric">\n' % guid.generate())
+
+        now = START_TIME
+        strokeCount = 0
+        while strokeCount < numStrokes:
+            isText = rand.random() < textFraction
+            runLength = min(numStrokes - strokeCount,
+                            rand.randint(3, 12) if isText else rand.randint(1, 3))
+            x = rand.randint(500, 20000)
+            y = rand.randint(500, 20000)
+            runSubstrokes = []
+            for r in range(runLength):
+                if isText:
+                    xy = textStroke(rand, x + r * 120, y, meanPoints)
+                else:
+                    xy = wireStroke(rand, x, y, meanPoints)
+
+                pointIds = guid.generate_batch(len(xy))
+                for (px, py), pid in zip(xy, pointIds):
+                    out.write('  <point x="%d" y="%d" pressure="127" time="%d" name="point" id="%s" />\n'
+                              % (px, py, now, pid))
+                    now += POINT_MS
+                numPoints += len(xy)
+                startTime = now - POINT_MS * len(xy)
+
+                xs = [p[0] for p in xy]
+                ys = [p[1] for p in xy]
+                ssid = guid.generate()
+                substrokeOut.write('  <shape type="substroke" name="substroke" id="%s" time="%d" '
+                                   'x="%d" y="%d" height="%d" width="%d" start="%s" end="%s" '
+                                   'source="Converter">\n'
+                                   % (ssid, startTime, min(xs), min(ys), max(ys) - min(ys),
+                                      max(xs) - min(xs), pointIds[0], pointIds[-1]))
+                for pid in pointIds:
+                    substrokeOut.write('    <arg type="point">%s</arg>\n' % pid)
+                substrokeOut.write('  </shape>\n')
+
+                strokeOut.write('  <shape type="stroke" name="stroke" id="%s" time="%d" x="%d" y="%d" '
+                                'height="0" width="0" start="%s" end="%s" source="Converter">\n'
+                                '    <arg type="substroke">%s</arg>\n'
+                                '  </shape>\n'
+                                % (guid.generate(), startTime, min(xs), min(ys), ssid, ssid, ssid))
+                runSubstrokes.append(ssid)
+                strokeCount += 1
+                # pen up time: short inside a word, longer between runs
+                now += rand.randint(100, 400) if isText else rand.randint(300, 1500)
+            now += rand.randint(500, 3000)
+
+            shapeType = 'Label' if isText else 'Wire'
+            shapeOut.write('  <shape type="%s" name="shape" id="%s" time="%d" start="%s" end="%s" '
+                           'source="Converter">\n'
+                           % (shapeType, guid.generate(), now, runSubstrokes[0], runSubstrokes[-1]))
+            for ssid in runSubstrokes:
+                shapeOut.write('    <arg type="substroke">%s</arg>\n' % ssid)
+            shapeOut.write('  </shape>\n')
+
+        for section in sections:
+            section.close()
+            with open(section.name) as f:
+                shutil.copyfileobj(f, out)
+        out.write('</sketch>\n')
+        out.close()
+    finally:
+        for section in sections:
+            section.close()
+        shutil.rmtree(tmpDir)
+    return numPoints
+
+
+def generateSizes(directory, sizes, meanPoints=20, seed=0):
+    ''' Write one sketch per size (number of strokes) into directory and
+        return the list of (size, filename) pairs '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    ret = []
+    for size in sizes:
+        filename = os.path.join(directory, 'synthetic_%d.labeled.xml' % size)
+        generateSketch(filename, size, meanPoints, seed=seed)
+        ret.append((size, filename))
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic labeled sketches')
+    parser.add_argument('-n', '--strokes', type=int, default=1000, help='number of strokes')
+    parser.add_argument('-o', '--output', help='file to write one sketch to')
+    parser.add_argument('--sizes', help='comma separated stroke counts, one sketch each')
+    parser.add_argument('-d', '--dir', default='.', help='directory for --sizes output')
+    parser.add_argument('-p', '--points', type=int, default=20, help='mean points per stroke')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args(argv)
+
+    if args.sizes:
+        sizes = [int(s) for s in args.sizes.split(',')]
+        for size, filename in generateSizes(args.dir, sizes, args.points, args.seed):
+            print "Wrote", size, "strokes to", filename
+    else:
+        output = args.output or 'synthetic_%d.labeled.xml' % args.strokes
+        numPoints = generateSketch(output, args.strokes, args.points, seed=args.seed)
+        print "Wrote", args.strokes, "strokes and", numPoints, "points to", output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#Command line batch labeling
+#-------------------------------------------------
+# Trains a StrokeLabeler and saves it as a shared model file (see
+# sharedmodel.py), or labels many sketch files with a saved model in a
+# pool of worker processes.  The model is written once and every worker
+# maps the same file, so starting a pool costs no more than opening it.
+# Inputs can be files, directories (their non-hidden files) or glob
+# patterns, which is handy when the shell's argument list is too short for
+# the corpus.  Each labeled sketch is written with saveFile to the output
+# directory under its input file name.
+#
+# The module is not called strokehmm because that name clashes with
+# StrokeHmm.py on case insensitive file systems.
+#
+# usage: python strokecli.py train --model m.bin [--order 2] [--global-bins]
+#                                  [--simplify 2] ../trainingFiles
+#        python strokecli.py label --model m.bin [-w 16] in/*.xml -o out/
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import StrokeHmm
+import sharedmodel
+
+
+def expandInputs( inputs ):
+    ''' The files named by inputs: files as they are, the non-hidden files
+        of directories and the matches of glob patterns, in order and
+        without repeats '''
+    sl = StrokeHmm.StrokeLabeler()
+    files = []
+    seen = set()
+    for name in inputs:
+        if os.path.isdir(name):
+            matches = sorted(sl.dirFiles(name))
+        elif os.path.exists(name):
+            matches = [name]
+        else:
+            matches = sorted(glob.glob(name))
+            if not matches:
+                raise ValueError('no files match ' + name)
+        for f in matches:
+            if f not in seen:
+                seen.add(f)
+                files.append(f)
+    return files
+
+
+def outputJobs( files, outDir ):
+    ''' (input file, output file) pairs writing every file to outDir under
+        its own name.  Two inputs with the same name would overwrite each
+        other, so that is an error. '''
+    jobs = []
+    targets = {}
+    for f in files:
+        out = os.path.join(outDir, os.path.basename(f))
+        if out in targets:
+            raise ValueError(f + ' and ' + targets[out] + ' would both be saved as ' + out)
+        targets[out] = f
+        jobs.append((f, out))
+    return jobs
+
+
+def train( args ):
+    sl = StrokeHmm.StrokeLabeler()
+    sl.order = args.order
+    sl.simplifyTolerance = args.simplify
+    files = expandInputs(args.inputs)
+    start = time.time()
+    sl.trainHMM(files, args.global_bins)
+    sharedmodel.save(sl, args.model)
+    print "Trained on", len(files), "files in", "%.2f s," % (time.time() - start), \
+          "model saved as", args.model
+    return 0
+
+
+def label( args ):
+    files = expandInputs(args.inputs)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    jobs = outputJobs(files, args.output)
+    start = time.time()
+    results = sharedmodel.labelFiles(args.model, jobs, args.workers)
+    seconds = time.time() - start
+
+    failures = [(f, error) for f, n, error in results if error is not None]
+    for f, error in failures:
+        print >> sys.stderr, "Failed", f + ":", error
+    labeled = len(results) - len(failures)
+    strokes = sum([n for f, n, error in results])
+    print "Labeled %d files (%d strokes) in %.2f s: %.1f files/s, %.0f strokes/s, %d failed" % \
+          (labeled, strokes, seconds, labeled / seconds if seconds > 0 else 0,
+           strokes / seconds if seconds > 0 else 0, len(failures))
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train and batch label stroke files')
+    commands = parser.add_subparsers(dest='command')
+
+    trainParser = commands.add_parser('train', help='train a model and save it')
+    trainParser.add_argument('--model', required=True, help='model file to write')
+    trainParser.add_argument('--order', type=int, default=1, choices=[1, 2],
+                             help='order of the HMM')
+    trainParser.add_argument('--global-bins', action='store_true',
+                             help='learn bin edges over all training strokes')
+    trainParser.add_argument('--simplify', type=float,
+                             help='simplify strokes with this tolerance when loading them')
+    trainParser.add_argument('inputs', nargs='+',
+                             help='labeled sketch files, directories or glob patterns')
+
+    labelParser = commands.add_parser('label', help='label sketch files with a saved model')
+    labelParser.add_argument('--model', required=True, help='model file written by train')
+    labelParser.add_argument('-w', '--workers', type=int,
+                             help='worker processes (default: one per CPU)')
+    labelParser.add_argument('-o', '--output', required=True,
+                             help='directory to write the labeled sketches to')
+    labelParser.add_argument('inputs', nargs='+',
+                             help='sketch files, directories or glob patterns')
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'train':
+            return train(args)
+        return label(args)
+    except (IOError, ValueError), e:
+        print >> sys.stderr, "Error:", e
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())